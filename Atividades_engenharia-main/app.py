@@ -1,16 +1,49 @@
 import os
+import re
+import csv
 import json
-import uuid
-from datetime import datetime, date
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, send_from_directory
+import shutil
+import mimetypes
+import base64
+import binascii
+import sqlite3
+import tempfile
+import threading
+import time
+import math
+import hmac
+import hashlib
+import secrets
+import zipfile
+from functools import wraps
+from datetime import datetime, date, timedelta, timezone
+from flask import Flask, Request, Response, has_request_context, render_template, request, redirect, url_for, flash, abort, send_file, send_from_directory, jsonify, make_response, session, g
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import Markup, escape
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from collections import Counter, OrderedDict
+from itertools import islice, repeat
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TempoEsgotado
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import and_, or_, tuple_, inspect, event, func, update
+from sqlalchemy.exc import OperationalError
+from flask.cli import AppGroup
+import click
+import queue
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele as páginas usam a imagem original
+    Image = ImageOps = None
+from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, login_url
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # --- CONFIGURAÇÃO ---
 basedir = os.path.abspath(os.path.dirname(__file__))
 usuarios_json_path = os.path.join(basedir, 'usuarios.json.bkp') # Apontando para o backup
+migrations_path = os.path.join(basedir, 'migrations')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'uma-chave-secreta-muito-segura-trocar-em-producao'
@@ -20,12 +53,102 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 UPLOAD_BASE_FOLDER = os.path.join(basedir, 'static', 'uploads')
 app.config['UPLOAD_FOLDER_ATIVIDADES'] = os.path.join(UPLOAD_BASE_FOLDER, 'atividades')
 app.config['UPLOAD_FOLDER_PEDIDOS'] = os.path.join(UPLOAD_BASE_FOLDER, 'pedidos')
+# Anexos novos ficam uma única vez por conteúdo, como <sha256>.<ext> (ver ARMAZENAMENTO POR CONTEÚDO).
+app.config['UPLOAD_FOLDER_CONTEUDO'] = os.path.join(UPLOAD_BASE_FOLDER, 'conteudo')
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'docx', 'xlsx', 'txt'}
+# Limite por arquivo, conferido enquanto o upload é recebido, e limite do corpo da requisição inteira.
+app.config['LIMITES_UPLOAD_MB'] = {'png': 15, 'jpg': 15, 'jpeg': 15, 'gif': 10, 'pdf': 50, 'docx': 25, 'xlsx': 25, 'txt': 5}
+app.config['MAX_CONTENT_LENGTH'] = 80 * 1024 * 1024
+# Entrega dos anexos: None (o Flask envia o arquivo), 'x-sendfile' (Apache/lighttpd) ou 'x-accel'
+# (nginx, com um location internal em ANEXOS_X_ACCEL_PREFIXO apontando para static/uploads).
+app.config['ANEXOS_OFFLOAD'] = os.environ.get('ANEXOS_OFFLOAD') or None
+app.config['ANEXOS_X_ACCEL_PREFIXO'] = os.environ.get('ANEXOS_X_ACCEL_PREFIXO', '/_anexos/')
+app.config['USE_X_SENDFILE'] = app.config['ANEXOS_OFFLOAD'] == 'x-sendfile'
+# Versões reduzidas das imagens anexadas (caixa máxima em pixels), em <pasta>/_derivados/
+app.config['DERIVADOS_IMAGEM'] = {'thumb': (320, 320), 'display': (1600, 1600), 'email': (800, 800)}
+# Reconciliação dos uploads: arquivos sem referência no banco vão para a quarentena e são apagados
+# depois de ANEXOS_QUARENTENA_DIAS. Arquivos mais novos que ANEXOS_GC_IDADE_MIN não são tocados.
+app.config['ANEXOS_GC_INTERVALO_MIN'] = int(os.environ.get('ANEXOS_GC_INTERVALO_MIN', 60))  # 0 = só pelo comando
+app.config['ANEXOS_GC_IDADE_MIN'] = int(os.environ.get('ANEXOS_GC_IDADE_MIN', 30))
+app.config['ANEXOS_QUARENTENA_DIAS'] = int(os.environ.get('ANEXOS_QUARENTENA_DIAS', 7))
+app.config['UPLOAD_FOLDER_QUARENTENA'] = os.path.join(UPLOAD_BASE_FOLDER, '_quarentena')
+# Envio em partes (API /api/uploads): tamanho de cada parte e por quantos dias um envio que não
+# foi usado em nenhuma atividade/pedido é guardado.
+app.config['UPLOAD_PARTE_MB'] = int(os.environ.get('UPLOAD_PARTE_MB', 4))
+app.config['UPLOAD_PARCIAL_DIAS'] = int(os.environ.get('UPLOAD_PARCIAL_DIAS', 2))
+app.config['UPLOAD_FOLDER_PARCIAIS'] = os.path.join(UPLOAD_BASE_FOLDER, '_parciais')
+app.config['ITENS_POR_PAGINA'] = 25
+app.config['HISTORICO_POR_PAGINA'] = 20
+app.config['CACHE_FRAGMENTOS_MAX'] = int(os.environ.get('CACHE_FRAGMENTOS_MAX', 5000))
+# HTML do "Copiar para Email" (com a imagem embutida, dezenas de KB cada)
+app.config['CACHE_EMAILS_MAX'] = int(os.environ.get('CACHE_EMAILS_MAX', 100))
+app.config['CACHE_USUARIOS_MAX'] = int(os.environ.get('CACHE_USUARIOS_MAX', 1000))
+app.config['CACHE_USUARIOS_TTL'] = int(os.environ.get('CACHE_USUARIOS_TTL', 60))  # segundos
+app.config['CACHE_TOKENS_MAX'] = int(os.environ.get('CACHE_TOKENS_MAX', 1000))
+app.config['CACHE_TOKENS_TTL'] = int(os.environ.get('CACHE_TOKENS_TTL', 60))  # segundos (revogação em outros processos)
+# Hash de senhas: custo usado em novos hashes (e no rehash transparente no login) e o pool de
+# processos que executa as verificações. 'flask senha benchmark' mede o custo nesta máquina.
+app.config['SENHA_METODO'] = os.environ.get('SENHA_METODO', 'pbkdf2:sha256:600000')
+app.config['SENHA_PROCESSOS'] = int(os.environ.get('SENHA_PROCESSOS', min(4, os.cpu_count() or 1)))  # 0 = na própria thread
+app.config['SENHA_FILA_MAX'] = int(os.environ.get('SENHA_FILA_MAX', 16))
+app.config['SENHA_TIMEOUT'] = float(os.environ.get('SENHA_TIMEOUT', 10))  # segundos
+# Limite de tentativas de login por login: balde de LOGIN_RAJADA tentativas que recarrega
+# LOGIN_POR_MINUTO por minuto, mais bloqueio exponencial após falhas seguidas.
+app.config['LOGIN_RAJADA'] = int(os.environ.get('LOGIN_RAJADA', 5))
+app.config['LOGIN_POR_MINUTO'] = float(os.environ.get('LOGIN_POR_MINUTO', 5))
+app.config['LOGIN_FALHAS_LIVRES'] = int(os.environ.get('LOGIN_FALHAS_LIVRES', 3))
+app.config['LOGIN_BLOQUEIO_MAX'] = int(os.environ.get('LOGIN_BLOQUEIO_MAX', 900))  # segundos
+# Limite por endereço IP, bem mais folgado e sem bloqueio por falhas: atrás do NAT da fábrica ou
+# de um proxy todos os usuários chegam pelo mesmo endereço (ex.: início de turno).
+app.config['LOGIN_IP_RAJADA'] = int(os.environ.get('LOGIN_IP_RAJADA', 200))
+app.config['LOGIN_IP_POR_MINUTO'] = float(os.environ.get('LOGIN_IP_POR_MINUTO', 120))
+# Quantos proxies reversos confiáveis (nginx...) estão na frente da aplicação; com 1 ou mais, o
+# endereço do cliente vem de X-Forwarded-For (ProxyFix). 0 = usar o endereço da conexão.
+app.config['PROXIES_CONFIAVEIS'] = int(os.environ.get('PROXIES_CONFIAVEIS', 0))
+app.config['LOGIN_LIMITADOR_MAX'] = int(os.environ.get('LOGIN_LIMITADOR_MAX', 10000))
+# Termos muito comuns são ranqueados só entre as N ocorrências mais recentes de cada tipo (ver busca()).
+app.config['BUSCA_JANELA_RANKING'] = 1000
+
+# Perfis de PRAGMAs aplicados a cada nova conexão SQLite (ver configurar_conexao_sqlite).
+# 'padrao' mantém o comportamento original do SQLite (journal de rollback, leitores
+# bloqueados durante a gravação); 'concorrente' usa WAL para que leituras não esperem escritas.
+PERFIS_SQLITE = {
+    'padrao': {},
+    'concorrente': {
+        'busy_timeout': 5000,           # ms esperando um lock antes de "database is locked"
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',        # seguro com WAL; só o checkpoint faz fsync
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,           # valor negativo = KiB (64 MB)
+        'temp_store': 'MEMORY',
+    },
+}
+app.config['SQLITE_PERFIL'] = os.environ.get('SQLITE_PERFIL', 'concorrente')
+
+if app.config['PROXIES_CONFIAVEIS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXIES_CONFIAVEIS'], x_proto=app.config['PROXIES_CONFIAVEIS'])
 
 os.makedirs(app.config['UPLOAD_FOLDER_ATIVIDADES'], exist_ok=True)
 os.makedirs(app.config['UPLOAD_FOLDER_PEDIDOS'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_FOLDER_CONTEUDO'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_FOLDER_PARCIAIS'], exist_ok=True)
 
 db = SQLAlchemy(app)
+
+def aplicar_pragmas(conexao, pragmas):
+    cursor = conexao.cursor()
+    for nome, valor in pragmas.items():
+        cursor.execute(f"PRAGMA {nome} = {valor}")
+    cursor.close()
+
+def configurar_conexao_sqlite(dbapi_connection, connection_record):
+    """Aplica o perfil SQLITE_PERFIL a cada conexão aberta pelo pool do SQLAlchemy."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        aplicar_pragmas(dbapi_connection, PERFIS_SQLITE[app.config['SQLITE_PERFIL']])
+
+with app.app_context():
+    event.listen(db.engine, 'connect', configurar_conexao_sqlite)
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = "Por favor, faça o login para acessar esta página."
@@ -36,6 +159,356 @@ login_manager.login_message_category = "info"
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+# --- UPLOADS ---
+# Os arquivos enviados são gravados direto num temporário em static/uploads (mesmo sistema de
+# arquivos das pastas finais) enquanto o Werkzeug lê a requisição, com o limite da extensão
+# conferido e o SHA-256 calculado a cada bloco. O temporário só é renomeado para o nome final
+# depois do commit que o referencia; em rollback, ou se ninguém o usar, ele é apagado.
+class ArquivoEmRecepcao:
+    """Destino de um arquivo do multipart: grava em disco, soma o tamanho e calcula o hash."""
+    def __init__(self, filename):
+        ext = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        limite_mb = app.config['LIMITES_UPLOAD_MB'].get(ext) if allowed_file(filename or '') else None
+        self.limite = limite_mb * 1024 * 1024 if limite_mb else None
+        self.tamanho = 0
+        self.sha256 = hashlib.sha256()
+        # Extensões não permitidas são descartadas (as rotas as ignoram), sem tocar o disco.
+        self.arquivo = tempfile.NamedTemporaryFile(dir=UPLOAD_BASE_FOLDER, prefix='.recebendo-', delete=False) \
+            if self.limite else None
+        self.caminho = self.arquivo.name if self.arquivo else None
+
+    def write(self, dados):
+        self.tamanho += len(dados)
+        if self.arquivo is None:
+            return len(dados)
+        if self.tamanho > self.limite:
+            self.descartar()
+            raise RequestEntityTooLarge(f'Arquivo acima do limite de {self.limite // (1024 * 1024)} MB para este tipo.')
+        self.sha256.update(dados)
+        return self.arquivo.write(dados)
+
+    def seek(self, *args):
+        return self.arquivo.seek(*args) if self.arquivo else 0
+
+    def read(self, *args):
+        return self.arquivo.read(*args) if self.arquivo else b''
+
+    def tell(self):
+        return self.arquivo.tell() if self.arquivo else self.tamanho
+
+    def flush(self):
+        if self.arquivo:
+            self.arquivo.flush()
+
+    def close(self):
+        if self.arquivo and not self.arquivo.closed:
+            self.arquivo.close()
+
+    def descartar(self):
+        self.close()
+        if self.caminho and os.path.exists(self.caminho):
+            os.remove(self.caminho)
+
+class RequisicaoComUploads(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        arquivo = ArquivoEmRecepcao(filename)
+        g.setdefault('arquivos_recebidos', []).append(arquivo)
+        return arquivo
+
+app.request_class = RequisicaoComUploads
+
+# Nomes do armazenamento por conteúdo; os demais (ativ_<uuid>, img_<uuid>...) são anexos antigos,
+# um arquivo por registro, nas pastas de atividades/pedidos.
+PADRAO_NOME_CONTEUDO = re.compile(r'^[0-9a-f]{64}\.')
+
+def pasta_do_anexo(folder, filename):
+    """Diretório onde está o anexo (ou derivado) `filename` da pasta lógica `folder`."""
+    if PADRAO_NOME_CONTEUDO.match(os.path.basename(filename)):
+        return app.config['UPLOAD_FOLDER_CONTEUDO']
+    if folder == 'atividades':
+        return app.config['UPLOAD_FOLDER_ATIVIDADES']
+    if folder == 'pedidos':
+        return app.config['UPLOAD_FOLDER_PEDIDOS']
+    return None
+
+# Dentro de cada pasta os arquivos ficam em duas subpastas tiradas de um hash do nome
+# (<ab>/<cd>/<nome>), para nenhum diretório acumular centenas de milhares de entradas. Nomes do
+# armazenamento por conteúdo já são um hash; os antigos usam o md5 do nome. Arquivos que ainda
+# estão na raiz da pasta (anteriores a `flask anexos fragmentar`) continuam sendo encontrados.
+def subpastas_do_anexo(nome):
+    chave = nome if PADRAO_NOME_CONTEUDO.match(nome) else hashlib.md5(nome.encode('utf-8')).hexdigest()
+    return chave[:2], chave[2:4]
+
+def caminho_fragmentado(pasta, nome, chave=None):
+    return os.path.join(pasta, *subpastas_do_anexo(chave or nome), nome)
+
+def localizar_anexo(pasta, nome, chave=None):
+    """Caminho de `nome` em `pasta`: o fragmentado ou, se o arquivo ainda não foi migrado, o da raiz."""
+    caminho = caminho_fragmentado(pasta, nome, chave)
+    if os.path.exists(caminho):
+        return caminho
+    # Se a migração mover o arquivo entre as duas verificações, o fragmentado passa a existir.
+    plano = os.path.join(pasta, nome)
+    return plano if os.path.exists(plano) else caminho
+
+def percorrer_anexos(pasta, niveis=2):
+    """Arquivos de `pasta`, tanto os da raiz quanto os das subpastas <ab>/<cd>/."""
+    subpastas = []
+    with os.scandir(pasta) as entradas:
+        for entrada in entradas:
+            if entrada.is_file():
+                yield entrada
+            elif niveis and len(entrada.name) == 2 and entrada.is_dir():
+                subpastas.append(entrada.path)
+    for subpasta in sorted(subpastas):
+        yield from percorrer_anexos(subpasta, niveis - 1)
+
+def salvar_upload(file):
+    """
+    Nomeia o upload pelo conteúdo (<sha256>.<ext>) e agenda sua ida para o armazenamento depois
+    do commit. Devolve o nome a gravar no modelo; a contagem de referências é feita no flush.
+    """
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    if not isinstance(file.stream, ArquivoEmRecepcao):
+        # Arquivo que não veio do parser desta aplicação (ex.: construído em código).
+        recebido = ArquivoEmRecepcao(file.filename)
+        g.setdefault('arquivos_recebidos', []).append(recebido)
+        shutil.copyfileobj(file.stream, recebido, 64 * 1024)
+        file.stream = recebido
+    # Fechado antes do os.replace: no Windows um arquivo aberto não pode ser renomeado.
+    file.stream.close()
+    nome = f"{file.stream.sha256.hexdigest()}.{ext}"
+    registrar_upload_pendente(file.stream.caminho, nome, file.stream.tamanho)
+    return nome
+
+def registrar_upload_pendente(origem, nome, tamanho):
+    # Mesmo quando o conteúdo já existe, o temporário (idêntico) é renomeado por cima: assim o
+    # arquivo está no lugar depois do commit mesmo que outra transação o tenha liberado antes.
+    db.session.info.setdefault('uploads_pendentes', []).append(
+        (origem, caminho_fragmentado(app.config['UPLOAD_FOLDER_CONTEUDO'], nome)))
+    db.session.info.setdefault('tamanhos_upload', {})[nome] = tamanho
+
+@event.listens_for(db.session, 'after_commit')
+def concluir_uploads(session):
+    for origem, destino in session.info.pop('uploads_pendentes', []):
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(origem, destino)
+        if eh_imagem(destino):
+            agendar_derivados(app.config['UPLOAD_FOLDER_CONTEUDO'], os.path.basename(destino))
+    # Remoções ficam para a thread de manutenção, fora do caminho da requisição.
+    for pasta, nome in session.info.pop('remocoes_pendentes', []):
+        agendar_manutencao('remover', (pasta, nome))
+    liberados = session.info.pop('conteudos_liberados', None)
+    session.info.pop('tamanhos_upload', None)
+    if liberados:
+        agendar_manutencao('liberar', liberados)
+
+def remover_com_derivados(pasta, nome):
+    remover_derivados(pasta, nome)
+    caminho = localizar_anexo(pasta, nome)
+    if os.path.exists(caminho):
+        os.remove(caminho)
+
+def remover_derivados(pasta, nome):
+    for tipo in app.config['DERIVADOS_IMAGEM']:
+        derivado = localizar_anexo(os.path.join(pasta, '_derivados'), f'{nome}.{tipo}.jpg', chave=nome)
+        if os.path.exists(derivado):
+            os.remove(derivado)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def descartar_uploads(session, previous_transaction):
+    if previous_transaction.parent is not None:
+        return
+    for origem, _ in session.info.pop('uploads_pendentes', []):
+        # Arquivos montados pela API de envio em partes ficam onde estão, para uma nova tentativa.
+        if os.path.exists(origem) and not origem.startswith(app.config['UPLOAD_FOLDER_PARCIAIS']):
+            os.remove(origem)
+    for chave in ('remocoes_pendentes', 'conteudos_liberados', 'tamanhos_upload'):
+        session.info.pop(chave, None)
+
+# Miniatura ('thumb') e versão de tela ('display') de cada imagem anexada, em JPEG, geradas por
+# uma thread de fundo depois do commit do upload. Enquanto não existem, a URL da versão reduzida
+# entrega a original (ver uploaded_file).
+EXTENSOES_IMAGEM = {'png', 'jpg', 'jpeg', 'gif'}
+fila_derivados = queue.Queue()
+_thread_derivados = None
+_trava_derivados = threading.Lock()
+
+def eh_imagem(caminho):
+    return caminho.rsplit('.', 1)[-1].lower() in EXTENSOES_IMAGEM
+
+def caminhos_derivados(pasta, nome):
+    return {tipo: caminho_fragmentado(os.path.join(pasta, '_derivados'), f'{nome}.{tipo}.jpg', chave=nome)
+            for tipo in app.config['DERIVADOS_IMAGEM']}
+
+def gerar_derivados(pasta, nome, refazer=False):
+    """Gera as versões reduzidas de uma imagem; devolve quantas foram gravadas."""
+    if Image is None:
+        return 0
+    pendentes = {tipo: destino for tipo, destino in caminhos_derivados(pasta, nome).items()
+                 if refazer or not os.path.exists(destino)}
+    if not pendentes:
+        return 0
+    with Image.open(localizar_anexo(pasta, nome)) as original:
+        imagem = ImageOps.exif_transpose(original)
+        if imagem.mode in ('RGBA', 'LA', 'P'):
+            imagem = imagem.convert('RGBA')
+            fundo = Image.new('RGB', imagem.size, 'white')
+            fundo.paste(imagem, mask=imagem.getchannel('A'))
+            imagem = fundo
+        else:
+            imagem = imagem.convert('RGB')
+    for tipo, destino in pendentes.items():
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        reduzida = imagem.copy()
+        reduzida.thumbnail(app.config['DERIVADOS_IMAGEM'][tipo], Image.Resampling.LANCZOS)
+        temporario = f'{destino}.tmp'
+        reduzida.save(temporario, 'JPEG', quality=82, optimize=True, progressive=True)
+        os.replace(temporario, destino)
+    return len(pendentes)
+
+def _processar_fila_derivados():
+    while True:
+        pasta, nome = fila_derivados.get()
+        try:
+            if os.path.exists(localizar_anexo(pasta, nome)):
+                gerar_derivados(pasta, nome)
+        except Exception as e:
+            app.logger.warning(f"Falha ao gerar miniaturas de {nome}: {e}")
+        finally:
+            fila_derivados.task_done()
+
+def agendar_derivados(pasta, nome):
+    global _thread_derivados
+    if Image is None:
+        return
+    with _trava_derivados:
+        if _thread_derivados is None:
+            _thread_derivados = threading.Thread(target=_processar_fila_derivados, name='derivados', daemon=True)
+            _thread_derivados.start()
+    fila_derivados.put((pasta, nome))
+
+@app.template_global()
+def url_anexo(folder, filename, tipo=None, **kwargs):
+    """
+    URL de um anexo; com `tipo` ('thumb'/'display'), a da versão reduzida. A URL não depende de a
+    versão já ter sido gerada: páginas e fragmentos em cache (ETag, CACHE DE FRAGMENTOS) não mudam
+    quando a thread de derivados termina, então passam a receber a reduzida sem nova renderização.
+    """
+    if tipo and Image is not None and eh_imagem(filename):
+        filename = f'_derivados/{filename}.{tipo}.jpg'
+    return url_for('uploaded_file', folder=folder, filename=filename, **kwargs)
+
+anexos_cli = AppGroup('anexos', help='Arquivos anexados.')
+
+@anexos_cli.command('miniaturas')
+@click.option('--refazer', is_flag=True, help='Regera também as que já existem.')
+def anexos_miniaturas(refazer):
+    """Gera as miniaturas/versões de tela das imagens já enviadas."""
+    if Image is None:
+        raise click.ClickException("Pillow não está instalado (pip install Pillow).")
+    geradas = falhas = 0
+    for pasta in (app.config['UPLOAD_FOLDER_ATIVIDADES'], app.config['UPLOAD_FOLDER_PEDIDOS'],
+                  app.config['UPLOAD_FOLDER_CONTEUDO']):
+        for entrada in percorrer_anexos(pasta):
+            if not eh_imagem(entrada.name):
+                continue
+            try:
+                geradas += gerar_derivados(pasta, entrada.name, refazer)
+            except Exception as e:
+                falhas += 1
+                print(f"Falha em {entrada.name}: {e}")
+    print(f"{geradas} versão(ões) reduzida(s) gerada(s), {falhas} falha(s).")
+
+app.cli.add_command(anexos_cli)
+
+@app.teardown_request
+def limpar_arquivos_recebidos(exc):
+    # Temporários que não foram renomeados (campo vazio, extensão recusada, erro na rota).
+    for arquivo in g.pop('arquivos_recebidos', []):
+        arquivo.descartar()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_grande_demais(erro):
+    flash(erro.description if 'limite' in (erro.description or '') else
+          f"Envio acima do limite de {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB.", 'danger')
+    return redirect(request.url)
+
+def assinatura_ordenacao(ordenacao):
+    """Identifica uma ordenação (ex.: 'prioridade_id,-data_criacao,-id') para amarrar o cursor a ela."""
+    return ','.join(('-' if descendente else '') + coluna.key for coluna, descendente in ordenacao)
+
+def codificar_cursor(valores, ordenacao):
+    """Serializa os valores de ordenação da última linha de uma página em um token opaco para a URL."""
+    bruto = json.dumps([assinatura_ordenacao(ordenacao),
+                        *[v.isoformat() if isinstance(v, datetime) else v for v in valores]])
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decodificar_cursor(cursor, ordenacao):
+    """
+    Reverte codificar_cursor. Retorna None para cursores ausentes, inválidos ou gerados para outra
+    ordenação (volta para a 1ª página).
+    """
+    if not cursor:
+        return None
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        valores = json.loads(bruto)
+        if (not isinstance(valores, list) or len(valores) != len(ordenacao) + 1
+                or valores[0] != assinatura_ordenacao(ordenacao)):
+            return None
+        return [datetime.fromisoformat(v) if isinstance(coluna.type, db.DateTime) else v
+                for (coluna, _), v in zip(ordenacao, valores[1:])]
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+def filtro_keyset(ordenacao, valores):
+    """
+    Monta a condição "linhas depois do cursor" para uma ordenação [(coluna, descendente), ...].
+    Colunas consecutivas com a mesma direção viram uma comparação de tupla (row value),
+    que o SQLite resolve com uma busca direta no índice em vez de varrer as páginas anteriores.
+    Quando há direções mistas, o limite extra na primeira coluna permite a mesma busca pelo índice.
+    """
+    grupos = []
+    for (coluna, descendente), valor in zip(ordenacao, valores):
+        if grupos and grupos[-1][0] == descendente:
+            grupos[-1][1].append(coluna)
+            grupos[-1][2].append(valor)
+        else:
+            grupos.append((descendente, [coluna], [valor]))
+
+    condicoes, prefixo = [], []
+    for descendente, colunas, vals in grupos:
+        esquerda = tuple_(*colunas) if len(colunas) > 1 else colunas[0]
+        direita = tuple_(*vals) if len(vals) > 1 else vals[0]
+        condicoes.append(and_(*prefixo, esquerda < direita if descendente else esquerda > direita))
+        prefixo.extend(c == v for c, v in zip(colunas, vals))
+    if len(grupos) == 1:
+        return condicoes[0]
+    descendente, colunas, vals = grupos[0]
+    limite_inicial = colunas[0] <= vals[0] if descendente else colunas[0] >= vals[0]
+    return and_(limite_inicial, or_(*condicoes))
+
+def consulta_keyset(query, ordenacao, cursor, limite):
+    """Aplica cursor, ordenação e limite (+1 para saber se há próxima página) à consulta."""
+    valores = decodificar_cursor(cursor, ordenacao)
+    if valores is not None:
+        query = query.filter(filtro_keyset(ordenacao, valores))
+    query = query.order_by(*[coluna.desc() if descendente else coluna.asc() for coluna, descendente in ordenacao])
+    return query.limit(limite + 1)
+
+def paginar_keyset(query, ordenacao, cursor, limite):
+    """
+    Paginação por cursor (keyset): busca `limite` linhas após o cursor na ordenação dada.
+    Retorna (itens, proximo_cursor); proximo_cursor é None na última página.
+    """
+    itens = consulta_keyset(query, ordenacao, cursor, limite).all()
+    if len(itens) <= limite:
+        return itens, None
+    itens = itens[:limite]
+    ultimo = itens[-1]
+    return itens, codificar_cursor([getattr(ultimo, coluna.key) for coluna, _ in ordenacao], ordenacao)
+
 
 # --- MODELOS DE DADOS (com User no DB) ---
 class User(db.Model, UserMixin):
@@ -46,27 +519,263 @@ class User(db.Model, UserMixin):
     senha_hash = db.Column(db.String(200), nullable=False)
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
 
+class UsuarioSessao(UserMixin):
+    """Cópia somente leitura de um User, desligada da sessão do banco (é o current_user das requisições)."""
+    CAMPOS = ('id', 'login', 'nome', 'is_admin')
+
+    def __init__(self, usuario):
+        for campo in self.CAMPOS:
+            object.__setattr__(self, campo, getattr(usuario, campo))
+
+    def __setattr__(self, nome, valor):
+        raise AttributeError('UsuarioSessao é somente leitura; altere o User no banco.')
+
+class CacheTTL:
+    """Cache LRU com TTL, local ao processo (usuários da sessão e tokens de API)."""
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.itens = OrderedDict()
+        self.trava = threading.Lock()
+        self.acertos = self.faltas = self.expirados = self.despejos = self.invalidados = 0
+
+    def obter(self, chave):
+        with self.trava:
+            item = self.itens.get(chave)
+            if item is not None:
+                if item[0] > time.monotonic():
+                    self.itens.move_to_end(chave)
+                    self.acertos += 1
+                    return item[1]
+                del self.itens[chave]
+                self.expirados += 1
+            self.faltas += 1
+            return None
+
+    def guardar(self, chave, valor):
+        with self.trava:
+            self.itens[chave] = (time.monotonic() + self.ttl, valor)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.maximo:
+                self.itens.popitem(last=False)
+                self.despejos += 1
+
+    def invalidar(self, chaves):
+        with self.trava:
+            for chave in chaves:
+                if self.itens.pop(chave, None) is not None:
+                    self.invalidados += 1
+
+    def metricas(self):
+        with self.trava:
+            consultas = self.acertos + self.faltas
+            return {'itens': len(self.itens), 'maximo': self.maximo, 'ttl': self.ttl,
+                    'acertos': self.acertos, 'faltas': self.faltas, 'expirados': self.expirados,
+                    'despejos': self.despejos, 'invalidados': self.invalidados,
+                    'taxa_de_acerto': round(self.acertos / consultas, 4) if consultas else None}
+
+cache_usuarios = CacheTTL(app.config['CACHE_USUARIOS_MAX'], app.config['CACHE_USUARIOS_TTL'])
+
 @login_manager.user_loader
 def load_user(user_id):
     # user_id é a chave primária (id) da tabela User
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    usuario = cache_usuarios.obter(user_id)
+    if usuario is None:
+        registro = db.session.get(User, user_id)
+        if registro is None:
+            return None
+        usuario = UsuarioSessao(registro)
+        cache_usuarios.guardar(user_id, usuario)
+    return usuario
+
+class TokenApi(db.Model):
+    """Token pessoal para scripts. Só o HMAC do token é guardado; o valor aparece uma vez, na criação."""
+    __tablename__ = 'token_api'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    nome = db.Column(db.String(100), nullable=False)
+    prefixo = db.Column(db.String(12), nullable=False)
+    digest = db.Column(db.String(64), nullable=False, unique=True)
+    escopos = db.Column(db.String(100), nullable=False)  # separados por espaço (ver ESCOPOS_TOKEN)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expira_em = db.Column(db.DateTime, nullable=True)
+    revogado_em = db.Column(db.DateTime, nullable=True)
+    usuario = db.relationship('User')
+
+# 'leitura' libera GET/HEAD; 'escrita' libera os demais métodos.
+ESCOPOS_TOKEN = ('leitura', 'escrita')
+PREFIXO_TOKEN = 'ae_'
+
+def digest_token(token):
+    return hmac.new(app.config['SECRET_KEY'].encode(), token.encode(), hashlib.sha256).hexdigest()
+
+def gerar_token_api(usuario, nome, escopos, expira_em=None):
+    """Cria o TokenApi (sem commit) e devolve (registro, token em texto puro)."""
+    token = PREFIXO_TOKEN + secrets.token_urlsafe(32)
+    registro = TokenApi(usuario=usuario, nome=nome, prefixo=token[:12], digest=digest_token(token),
+                        escopos=' '.join(escopos), expira_em=expira_em)
+    db.session.add(registro)
+    return registro, token
+
+cache_tokens = CacheTTL(app.config['CACHE_TOKENS_MAX'], app.config['CACHE_TOKENS_TTL'])
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    """Autentica 'Authorization: Bearer <token>' sem sessão: um HMAC e, no caso comum, um acerto de cache."""
+    cabecalho = request.headers.get('Authorization', '')
+    if not cabecalho.startswith('Bearer ' + PREFIXO_TOKEN):
+        return None
+    digest = digest_token(cabecalho[len('Bearer '):].strip())
+    dados = cache_tokens.obter(digest)
+    if dados is None:
+        registro = TokenApi.query.filter_by(digest=digest).first()
+        # Tokens inexistentes também ficam no cache, para que repetições não cheguem ao banco.
+        dados = (None, (), None) if registro is None or registro.revogado_em else \
+            (registro.user_id, tuple(registro.escopos.split()), registro.expira_em)
+        cache_tokens.guardar(digest, dados)
+    user_id, escopos, expira_em = dados
+    if user_id is None or (expira_em is not None and expira_em <= datetime.utcnow()):
+        return None
+    if ('leitura' if request.method in ('GET', 'HEAD') else 'escrita') not in escopos:
+        return None
+    return load_user(user_id)
+
+@login_manager.unauthorized_handler
+def nao_autorizado():
+    # Scripts com token recebem 401 em vez do redirecionamento para a tela de login.
+    if request.headers.get('Authorization'):
+        return jsonify(erro='Token inválido, expirado ou sem o escopo necessário.'), 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(login_url(login_manager.login_view, request.url))
+
+# Usuários e tokens gravados são retirados do cache só depois do commit, para que uma requisição
+# concorrente não recoloque o valor antigo. Em outros processos a alteração aparece quando o TTL vence.
+@event.listens_for(db.session, 'after_flush')
+def registrar_alteracoes_em_cache(session, flush_context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            session.info.setdefault('usuarios_alterados', set()).add(obj.id)
+        elif isinstance(obj, TokenApi):
+            session.info.setdefault('tokens_alterados', set()).add(obj.digest)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidar_caches_alterados(session):
+    cache_usuarios.invalidar(session.info.pop('usuarios_alterados', ()))
+    cache_tokens.invalidar(session.info.pop('tokens_alterados', ()))
+
+@event.listens_for(db.session, 'after_rollback')
+def descartar_alteracoes_em_cache(session):
+    session.info.pop('usuarios_alterados', None)
+    session.info.pop('tokens_alterados', None)
+
+class Prioridade(db.Model):
+    """Tabela de apoio das prioridades. O id é o próprio nível (1 = mais urgente) e define a ordenação do quadro."""
+    __tablename__ = 'prioridade'
+    id = db.Column(db.SmallInteger, primary_key=True)
+    codigo = db.Column(db.String(10), unique=True, nullable=False)
+    descricao = db.Column(db.String(50), nullable=False)
+    css_slug = db.Column(db.String(50), nullable=False)
+
+    @classmethod
+    def por_codigo(cls, codigo):
+        prioridade = cls.query.filter_by(codigo=codigo).first()
+        if prioridade is None:
+            raise ValueError(f"Prioridade desconhecida: {codigo!r}")
+        return prioridade
+
+    def __str__(self):
+        return self.codigo
+
+class StatusAtividade(db.Model):
+    """Tabela de apoio dos status de atividade."""
+    __tablename__ = 'status_atividade'
+    INICIADO = 1
+    CONCLUIDO = 4
+
+    id = db.Column(db.SmallInteger, primary_key=True)
+    nome = db.Column(db.String(50), unique=True, nullable=False)
+    ordem = db.Column(db.SmallInteger, nullable=False)
+    css_slug = db.Column(db.String(50), nullable=False)
+
+    @classmethod
+    def por_nome(cls, nome):
+        status = cls.query.filter_by(nome=nome).first()
+        if status is None:
+            raise ValueError(f"Status desconhecido: {nome!r}")
+        return status
+
+    def __str__(self):
+        return self.nome
+
+# Conteúdo das tabelas de apoio; popular_tabelas_de_apoio() insere o que faltar.
+PRIORIDADES_PADRAO = [
+    (1, 'P-1', 'Urgente', 'p-1'),
+    (2, 'P-2', 'Alta', 'p-2'),
+    (3, 'P-3', 'Média', 'p-3'),
+    (4, 'P-4', 'Baixa', 'p-4'),
+    (5, 'P-5', 'Muito Baixa', 'p-5'),
+]
+STATUS_PADRAO = [
+    (StatusAtividade.INICIADO, 'Iniciado', 1, 'iniciado'),
+    (2, 'Com o Compras', 2, 'com-o-compras'),
+    (3, 'Com a Diretoria', 3, 'com-a-diretoria'),
+    (StatusAtividade.CONCLUIDO, 'Concluído', 4, 'concluido'),
+]
 
 class Atividade(db.Model):
     __tablename__ = 'atividade'
     id = db.Column(db.Integer, primary_key=True)
     nome_atividade = db.Column(db.String(200), nullable=False)
-    prioridade = db.Column(db.String(10), nullable=False, default='P-3')
+    prioridade_id = db.Column(db.SmallInteger, db.ForeignKey('prioridade.id'), nullable=False, default=3)
     imagem_anexo = db.Column(db.String(100), nullable=True)
     observacoes = db.Column(db.Text, nullable=True)
     data_criacao = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     centro_de_custo = db.Column(db.String(100), nullable=False)
-    status = db.Column(db.String(50), nullable=False, default='Iniciado')
+    status_id = db.Column(db.SmallInteger, db.ForeignKey('status_atividade.id'), nullable=False, default=StatusAtividade.INICIADO)
     responsavel_atual = db.Column(db.String(150), nullable=False)
     pedido = db.Column(db.String(100), nullable=True)
     local_de_entrega = db.Column(db.String(200), nullable=True)
     solicitante = db.Column(db.String(150), nullable=True)
     obra_destino = db.Column(db.String(200), nullable=True)
-    historico = db.relationship('HistoricoModificacao', backref='atividade', lazy=True, cascade="all, delete-orphan", order_by='desc(HistoricoModificacao.data_modificacao)')
+    # Incrementada a cada gravação da linha ou do seu histórico (chave do cache de fragmentos)
+    versao = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # 'dynamic': o histórico nunca é carregado implicitamente; quem precisa consulta uma página (ver pagina_historico).
+    historico = db.relationship('HistoricoModificacao', backref='atividade', lazy='dynamic', cascade="all, delete-orphan", order_by='desc(HistoricoModificacao.data_modificacao)')
+    prioridade_info = db.relationship('Prioridade', lazy='joined')
+    status_info = db.relationship('StatusAtividade', lazy='joined')
+    anexos = db.relationship('Anexo', backref='atividade', cascade="all, delete-orphan", order_by='Anexo.id')
+
+    # Os mesmos índices são criados em bancos existentes por migrations/0001 e 0003
+    __table_args__ = (
+        db.Index('ix_atividade_data_criacao', 'data_criacao'),
+        db.Index('ix_atividade_status_data_criacao', 'status_id', 'data_criacao'),
+        db.Index('ix_atividade_prioridade_data_criacao', db.desc('prioridade_id'), 'data_criacao'),
+        db.Index('ix_atividade_centro_de_custo_data', 'centro_de_custo', 'data_criacao'),
+        db.Index('ix_atividade_solicitante_data', 'solicitante', 'data_criacao'),
+        db.Index('ix_atividade_obra_destino_data', 'obra_destino', 'data_criacao'),
+        db.Index('ix_atividade_responsavel_atual_data', 'responsavel_atual', 'data_criacao'),
+    )
+
+    # Prioridade e status continuam legíveis/graváveis pelo rótulo (formulários e histórico),
+    # mas são armazenados como chaves inteiras para as tabelas de apoio.
+    @property
+    def prioridade(self):
+        return self.prioridade_info.codigo if self.prioridade_info else None
+
+    @prioridade.setter
+    def prioridade(self, codigo):
+        if codigo is not None:
+            self.prioridade_info = Prioridade.por_codigo(codigo)
+
+    @property
+    def status(self):
+        return self.status_info.nome if self.status_info else None
+
+    @status.setter
+    def status(self, nome):
+        if nome is not None:
+            self.status_info = StatusAtividade.por_nome(nome)
 
 class HistoricoModificacao(db.Model):
     __tablename__ = 'historico_modificacao'
@@ -78,6 +787,10 @@ class HistoricoModificacao(db.Model):
     modificado_por = db.Column(db.String(150), nullable=False)
     atividade_id = db.Column(db.Integer, db.ForeignKey('atividade.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_historico_modificacao_atividade_data', 'atividade_id', 'data_modificacao'),
+    )
+
 class PedidoProducao(db.Model):
     __tablename__ = 'pedido_producao'
     id = db.Column(db.Integer, primary_key=True)
@@ -93,25 +806,1147 @@ class PedidoProducao(db.Model):
     anexo_arquivo_filename = db.Column(db.String(100), nullable=True)
     data_criacao = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     criado_por = db.Column(db.String(150), nullable=False)
+    versao = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    anexos = db.relationship('Anexo', backref='pedido_producao', cascade="all, delete-orphan", order_by='Anexo.id')
+
+    __table_args__ = (
+        db.Index('ix_pedido_producao_data_criacao', 'data_criacao'),
+    )
+
+class Anexo(db.Model):
+    """Arquivo adicional de uma atividade ou de um pedido, no armazenamento por conteúdo."""
+    __tablename__ = 'anexo'
+    id = db.Column(db.Integer, primary_key=True)
+    atividade_id = db.Column(db.Integer, db.ForeignKey('atividade.id'), nullable=True)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido_producao.id'), nullable=True)
+    nome_arquivo = db.Column(db.String(80), nullable=False)  # <sha256>.<ext>
+    nome_original = db.Column(db.String(255), nullable=False)
+    tamanho = db.Column(db.Integer, nullable=True)
+    enviado_por = db.Column(db.String(150), nullable=False)
+    data_envio = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_anexo_atividade_id', 'atividade_id'),
+        db.Index('ix_anexo_pedido_id', 'pedido_id'),
+    )
+
+    @property
+    def dono(self):
+        return self.atividade or self.pedido_producao
+
+class UploadParcial(db.Model):
+    """Envio em partes pela API /api/uploads; as partes ficam em UPLOAD_FOLDER_PARCIAIS/<id>/."""
+    __tablename__ = 'upload_parcial'
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    nome_original = db.Column(db.String(255), nullable=False)
+    tamanho = db.Column(db.Integer, nullable=False)
+    tamanho_parte = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True)  # preenchido quando o arquivo é montado
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @property
+    def total_partes(self):
+        return math.ceil(self.tamanho / self.tamanho_parte)
+
+    @property
+    def extensao(self):
+        return self.nome_original.rsplit('.', 1)[1].lower()
+
+    @property
+    def pasta(self):
+        return os.path.join(app.config['UPLOAD_FOLDER_PARCIAIS'], self.id)
+
+    @property
+    def caminho_montado(self):
+        return os.path.join(self.pasta, 'arquivo')
+
+    def caminho_parte(self, numero):
+        return os.path.join(self.pasta, f'{numero}.parte')
+
+    def tamanho_da_parte(self, numero):
+        return min(self.tamanho_parte, self.tamanho - numero * self.tamanho_parte)
+
+    def partes_recebidas(self):
+        """Números das partes já gravadas; o disco é a referência, então sobrevive a reinícios."""
+        try:
+            nomes = os.listdir(self.pasta)
+        except FileNotFoundError:
+            return []
+        return sorted(int(nome[:-6]) for nome in nomes if nome.endswith('.parte') and nome[:-6].isdigit())
+
+class ContadorPainel(db.Model):
+    """Contadores do dashboard, mantidos a cada flush (ver seção CONTADORES DO PAINEL)."""
+    __tablename__ = 'contador_painel'
+    chave = db.Column(db.String(200), primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
+class ArquivoConteudo(db.Model):
+    """Um arquivo do armazenamento por conteúdo e quantas colunas de anexo apontam para ele."""
+    __tablename__ = 'arquivo_conteudo'
+    nome = db.Column(db.String(80), primary_key=True)  # <sha256>.<ext>
+    tamanho = db.Column(db.Integer, nullable=True)
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class VersaoDados(db.Model):
+    """Linha única (id=1) incrementada a cada gravação de dados exibidos nas páginas (ETag/Last-Modified)."""
+    __tablename__ = 'versao_dados'
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=1)
+    modificado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class VersaoSchema(db.Model):
+    """Registro das migrações de migrations/ já aplicadas a este banco."""
+    __tablename__ = 'schema_version'
+    versao = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(200), nullable=False)
+    aplicada_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Filtros de texto da lista de atividades; cada coluna tem um índice (coluna, data_criacao).
+FILTROS_TEXTO_ATIVIDADE = {
+    'centro_de_custo': 'Centro de Custo', 'solicitante': 'Solicitante',
+    'obra_destino': 'Obra / Destino', 'responsavel_atual': 'Responsável',
+}
+ORDENACOES_ATIVIDADE = {
+    'prioridade': ('Prioridade', [(Atividade.prioridade_id, False), (Atividade.data_criacao, True), (Atividade.id, True)]),
+    'recentes': ('Mais recentes', [(Atividade.data_criacao, True), (Atividade.id, True)]),
+    'antigas': ('Mais antigas', [(Atividade.data_criacao, False), (Atividade.id, False)]),
+}
+
+def ler_filtros_atividade(args):
+    """Extrai da query string os filtros válidos da lista de atividades (só os preenchidos)."""
+    filtros = {}
+    for campo in FILTROS_TEXTO_ATIVIDADE:
+        valor = args.get(campo, '').strip()
+        if valor:
+            filtros[campo] = valor
+    for campo in ('status', 'prioridade'):
+        valor = args.get(campo, type=int)
+        if valor is not None:
+            filtros[campo] = valor
+    for campo in ('data_inicio', 'data_fim'):
+        try:
+            filtros[campo] = date.fromisoformat(args.get(campo, '')).isoformat()
+        except ValueError:
+            pass
+    if args.get('ordenar') in ORDENACOES_ATIVIDADE:
+        filtros['ordenar'] = args['ordenar']
+    return filtros
+
+def aplicar_filtros_atividade(query, filtros):
+    for campo in FILTROS_TEXTO_ATIVIDADE:
+        if campo in filtros:
+            # Busca por prefixo como intervalo [valor, valor + U+10FFFF): usa o índice, ao contrário de LIKE.
+            coluna = getattr(Atividade, campo)
+            query = query.filter(coluna >= filtros[campo], coluna < filtros[campo] + '\U0010ffff')
+    if 'status' in filtros:
+        query = query.filter(Atividade.status_id == filtros['status'])
+    if 'prioridade' in filtros:
+        query = query.filter(Atividade.prioridade_id == filtros['prioridade'])
+    if 'data_inicio' in filtros or 'data_fim' in filtros:
+        # Sempre um intervalo fechado: com um lado só, o planejador do SQLite pode preferir
+        # percorrer o índice da ordenação inteiro em vez de buscar em ix_atividade_data_criacao.
+        inicio = datetime.fromisoformat(filtros.get('data_inicio', date.min.isoformat()))
+        fim = datetime.max
+        # Não existe dia seguinte a 9999-12-31: nesse caso o intervalo fica aberto até datetime.max.
+        if filtros.get('data_fim', date.max.isoformat()) < date.max.isoformat():
+            fim = datetime.fromisoformat(filtros['data_fim']) + timedelta(days=1)
+        query = query.filter(Atividade.data_criacao >= inicio, Atividade.data_criacao < fim)
+    return query
+
+def paineis_atividades(filtros):
+    """Consultas e ordenações dos painéis "em andamento" e "concluídas" com os filtros aplicados."""
+    base = aplicar_filtros_atividade(Atividade.query, filtros)
+    ordenar = filtros.get('ordenar')
+    return {
+        'andamento': (base.filter(Atividade.status_id != StatusAtividade.CONCLUIDO),
+                      ORDENACOES_ATIVIDADE[ordenar or 'prioridade'][1]),
+        'concluidas': (base.filter(Atividade.status_id == StatusAtividade.CONCLUIDO),
+                       ORDENACOES_ATIVIDADE[ordenar or 'recentes'][1]),
+    }
+
+ORDEM_HISTORICO = [(HistoricoModificacao.data_modificacao, True), (HistoricoModificacao.id, True)]
+
+def pagina_historico(atividade_id, cursor=None):
+    """Uma página do histórico da atividade, do mais recente para o mais antigo (usa ix_historico_modificacao_atividade_data)."""
+    return paginar_keyset(HistoricoModificacao.query.filter_by(atividade_id=atividade_id), ORDEM_HISTORICO,
+                          cursor, app.config['HISTORICO_POR_PAGINA'])
+
+def opcoes_formulario_atividade():
+    """Opções dos selects de prioridade e status do formulário de atividade."""
+    return {
+        'prioridades': Prioridade.query.order_by(Prioridade.id).all(),
+        'status_opcoes': StatusAtividade.query.order_by(StatusAtividade.ordem).all(),
+    }
+
+
+# --- ARMAZENAMENTO POR CONTEÚDO ---
+# As colunas de anexo guardam <sha256>.<ext>; arquivo_conteudo conta quantas colunas apontam para
+# cada arquivo. O flush aplica a diferença entre os nomes gravados antes e depois (como nos
+# contadores do painel) e, depois do commit, arquivos sem referência são apagados. Anexos antigos
+# (um arquivo por registro) continuam sendo apagados quando deixam de ser referenciados.
+COLUNAS_ANEXO = {
+    'Atividade': ('imagem_anexo',),
+    'PedidoProducao': ('anexo_imagem_filename', 'anexo_arquivo_filename'),
+    'Anexo': ('nome_arquivo',),
+}
+# Anexo só recebe nomes do armazenamento por conteúdo, que não dependem da pasta lógica.
+PASTA_LOGICA_ANEXO = {'Atividade': 'atividades', 'PedidoProducao': 'pedidos', 'Anexo': 'conteudo'}
+
+@event.listens_for(db.session, 'before_flush')
+def registrar_anexos_antes_do_flush(session, flush_context, instances):
+    antes = session.info.setdefault('anexos_antes', {})
+    pendentes = {}
+    for obj in list(session.dirty) + list(session.deleted):
+        if type(obj).__name__ in COLUNAS_ANEXO and obj not in antes and obj.id is not None:
+            pendentes.setdefault(type(obj), {})[obj.id] = obj
+    for modelo, objetos in pendentes.items():
+        colunas = [getattr(modelo, coluna) for coluna in COLUNAS_ANEXO[modelo.__name__]]
+        with session.no_autoflush:
+            linhas = session.execute(db.select(modelo.id, *colunas).where(modelo.id.in_(list(objetos)))).all()
+        for linha in linhas:
+            antes[objetos[linha[0]]] = [nome for nome in linha[1:] if nome]
+
+def anexos_do_objeto(obj):
+    return [nome for nome in (getattr(obj, coluna) for coluna in COLUNAS_ANEXO[type(obj).__name__]) if nome]
+
+@event.listens_for(db.session, 'after_flush')
+def atualizar_referencias_apos_flush(session, flush_context):
+    antes = session.info.pop('anexos_antes', {})
+    deltas = Counter()
+    for obj in session.new:
+        if type(obj).__name__ in COLUNAS_ANEXO:
+            deltas.update((PASTA_LOGICA_ANEXO[type(obj).__name__], nome) for nome in anexos_do_objeto(obj))
+    for obj, nomes_antes in antes.items():
+        pasta = PASTA_LOGICA_ANEXO[type(obj).__name__]
+        deltas.subtract((pasta, nome) for nome in nomes_antes)
+        if obj not in session.deleted:
+            deltas.update((pasta, nome) for nome in anexos_do_objeto(obj))
+
+    referencias = Counter()
+    for (pasta, nome), delta in deltas.items():
+        if PADRAO_NOME_CONTEUDO.match(nome):
+            referencias[nome] += delta
+        elif delta < 0:
+            session.info.setdefault('remocoes_pendentes', []).append((pasta_do_anexo(pasta, nome), nome))
+    referencias = {nome: delta for nome, delta in referencias.items() if delta}
+    if not referencias:
+        return
+    tamanhos = session.info.get('tamanhos_upload', {})
+    session.connection().execute(db.text(
+        "INSERT INTO arquivo_conteudo (nome, tamanho, referencias, criado_em) VALUES (:nome, :tamanho, :delta, :agora) "
+        "ON CONFLICT (nome) DO UPDATE SET referencias = referencias + excluded.referencias, "
+        "tamanho = coalesce(tamanho, excluded.tamanho)"),
+        [{'nome': nome, 'tamanho': tamanhos.get(nome), 'delta': delta, 'agora': datetime.utcnow()}
+         for nome, delta in referencias.items()])
+    session.info.setdefault('conteudos_liberados', set()).update(nome for nome, delta in referencias.items() if delta < 0)
+
+def liberar_conteudos(nomes):
+    """Apaga os arquivos que ficaram sem referência (a linha sai e o arquivo é removido sob a mesma trava de escrita)."""
+    with db.engine.begin() as conexao:
+        for nome in nomes:
+            apagada = conexao.execute(db.text(
+                "DELETE FROM arquivo_conteudo WHERE nome = :nome AND referencias <= 0"), {'nome': nome}).rowcount
+            if apagada:
+                remover_com_derivados(app.config['UPLOAD_FOLDER_CONTEUDO'], nome)
+
+# --- Manutenção em segundo plano ---
+# Uma thread por processo recebe as remoções agendadas pelos commits e, a cada
+# ANEXOS_GC_INTERVALO_MIN, reconcilia as pastas de upload com o banco. Tudo é idempotente:
+# vários processos podem reconciliar ao mesmo tempo (quem chegar depois só não acha o arquivo).
+fila_manutencao = queue.Queue()
+_thread_manutencao = None
+_trava_manutencao = threading.Lock()
+
+def agendar_manutencao(tarefa, argumento):
+    iniciar_manutencao()
+    fila_manutencao.put((tarefa, argumento))
+
+def iniciar_manutencao():
+    global _thread_manutencao
+    if _thread_manutencao is not None:
+        return
+    with _trava_manutencao:
+        if _thread_manutencao is None:
+            _thread_manutencao = threading.Thread(target=_processar_manutencao, name='manutencao', daemon=True)
+            _thread_manutencao.start()
+
+def _processar_manutencao():
+    intervalo = app.config['ANEXOS_GC_INTERVALO_MIN'] * 60
+    proxima = time.monotonic() + intervalo
+    while True:
+        try:
+            tarefa, argumento = fila_manutencao.get(timeout=max(1, proxima - time.monotonic()) if intervalo else None)
+        except queue.Empty:
+            tarefa, argumento = 'reconciliar', None
+        try:
+            with app.app_context():
+                if tarefa == 'remover':
+                    remover_com_derivados(*argumento)
+                elif tarefa == 'liberar':
+                    liberar_conteudos(argumento)
+                elif tarefa == 'reconciliar':
+                    proxima = time.monotonic() + intervalo
+                    reconciliar_uploads()
+        except Exception as e:
+            app.logger.warning(f"Falha na manutenção de anexos ({tarefa}): {e}")
+        finally:
+            if tarefa != 'reconciliar':
+                fila_manutencao.task_done()
+
+@app.before_request
+def garantir_manutencao():
+    if _thread_manutencao is None and app.config['ANEXOS_GC_INTERVALO_MIN']:
+        iniciar_manutencao()
+
+def nomes_referenciados():
+    """Todos os nomes de anexo gravados no banco, numa única consulta."""
+    consultas = [db.select(getattr(modelo, coluna)).where(getattr(modelo, coluna).isnot(None))
+                 for modelo in (Atividade, PedidoProducao, Anexo) for coluna in COLUNAS_ANEXO[modelo.__name__]]
+    return set(db.session.execute(db.union(*consultas)).scalars())
+
+def reconciliar_uploads(dry_run=False):
+    """
+    Move para a quarentena os arquivos que nenhum registro referencia, devolve os que voltaram
+    a ser referenciados e apaga os que passaram da carência. Devolve um Counter com o resumo.
+    """
+    resultado = Counter()
+    agora = time.time()
+    limite_idade = agora - app.config['ANEXOS_GC_IDADE_MIN'] * 60
+    limite_quarentena = agora - app.config['ANEXOS_QUARENTENA_DIAS'] * 86400
+    quarentena = app.config['UPLOAD_FOLDER_QUARENTENA']
+    referenciados = nomes_referenciados()
+
+    pastas = {'atividades': app.config['UPLOAD_FOLDER_ATIVIDADES'], 'pedidos': app.config['UPLOAD_FOLDER_PEDIDOS'],
+              'conteudo': app.config['UPLOAD_FOLDER_CONTEUDO']}
+    for rotulo, pasta in pastas.items():
+        for entrada in percorrer_anexos(pasta):
+            if entrada.name in referenciados:
+                continue
+            try:
+                if entrada.stat().st_mtime > limite_idade:
+                    continue
+                resultado['quarentena'] += 1
+                resultado['bytes'] += entrada.stat().st_size
+                if dry_run:
+                    continue
+                destino = os.path.join(quarentena, rotulo, entrada.name)
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                os.replace(entrada.path, destino)
+                os.utime(destino)  # início da carência
+                remover_derivados(pasta, entrada.name)
+            except FileNotFoundError:
+                pass
+    # Temporários de uploads que não chegaram ao commit
+    with os.scandir(UPLOAD_BASE_FOLDER) as entradas:
+        for entrada in entradas:
+            if entrada.is_file() and entrada.name.startswith('.recebendo-') and entrada.stat().st_mtime < limite_idade:
+                resultado['temporarios'] += 1
+                if not dry_run:
+                    try:
+                        os.remove(entrada.path)
+                    except FileNotFoundError:
+                        pass
+
+    # Envios em partes abandonados e pastas de envios que já foram anexados
+    limite_parciais = datetime.utcnow() - timedelta(days=app.config['UPLOAD_PARCIAL_DIAS'])
+    vencidos = [id_ for (id_,) in db.session.query(UploadParcial.id).filter(UploadParcial.criado_em < limite_parciais)]
+    ativos = {id_ for (id_,) in db.session.query(UploadParcial.id)} - set(vencidos)
+    with os.scandir(app.config['UPLOAD_FOLDER_PARCIAIS']) as entradas:
+        for entrada in entradas:
+            if entrada.name in ativos or entrada.stat().st_mtime > limite_idade:
+                continue
+            resultado['parciais'] += 1
+            if not dry_run:
+                shutil.rmtree(entrada.path, ignore_errors=True)
+    if vencidos and not dry_run:
+        UploadParcial.query.filter(UploadParcial.id.in_(vencidos)).delete(synchronize_session=False)
+        db.session.commit()
+
+    for rotulo, pasta in pastas.items():
+        pasta_quarentena = os.path.join(quarentena, rotulo)
+        if not os.path.isdir(pasta_quarentena):
+            continue
+        with os.scandir(pasta_quarentena) as entradas:
+            for entrada in entradas:
+                try:
+                    if entrada.name in referenciados:
+                        resultado['restaurados'] += 1
+                        if not dry_run:
+                            destino = caminho_fragmentado(pasta, entrada.name)
+                            os.makedirs(os.path.dirname(destino), exist_ok=True)
+                            os.replace(entrada.path, destino)
+                    elif entrada.stat().st_mtime < limite_quarentena:
+                        resultado['apagados'] += 1
+                        if not dry_run:
+                            os.remove(entrada.path)
+                except FileNotFoundError:
+                    pass
+
+    if not dry_run:
+        # Linhas de arquivo_conteudo cujo arquivo saiu do armazenamento.
+        presentes = {entrada.name for entrada in percorrer_anexos(app.config['UPLOAD_FOLDER_CONTEUDO'])}
+        orfas = [nome for (nome,) in db.session.query(ArquivoConteudo.nome)
+                 if nome not in presentes and nome not in referenciados]
+        if orfas:
+            ArquivoConteudo.query.filter(ArquivoConteudo.nome.in_(orfas)).delete(synchronize_session=False)
+            db.session.commit()
+    return resultado
+
+@anexos_cli.command('reconciliar')
+@click.option('--dry-run', is_flag=True, help='Só relata o que seria movido/apagado.')
+def anexos_reconciliar(dry_run):
+    """Põe em quarentena os arquivos órfãos e apaga os que passaram da carência."""
+    r = reconciliar_uploads(dry_run)
+    prefixo = "[dry-run] " if dry_run else ""
+    print(f"{prefixo}{r['quarentena']} arquivo(s) para a quarentena ({r['bytes'] / (1024 * 1024):.1f} MB), "
+          f"{r['restaurados']} restaurado(s), {r['apagados']} apagado(s) da quarentena, "
+          f"{r['temporarios']} temporário(s) e {r['parciais']} envio(s) em partes removido(s).")
+
+def hash_de_arquivo(caminho):
+    sha256 = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(bloco)
+    return sha256.hexdigest()
+
+@anexos_cli.command('deduplicar')
+@click.option('--lote', default=200, show_default=True, help='Registros por transação (o comando pode ser retomado).')
+@click.option('--dry-run', is_flag=True, help='Só calcula quanto seria economizado.')
+def anexos_deduplicar(lote, dry_run):
+    """Move os anexos antigos (um arquivo por registro) para o armazenamento por conteúdo."""
+    movidos = repetidos = economizados = ausentes = 0
+    vistos = set()
+    # Trocar o nome do arquivo pelo hash não é uma alteração da atividade.
+    db.session.info['auditoria_suspensa'] = True
+    for modelo in (Atividade, PedidoProducao):
+        nome_modelo = modelo.__name__
+        pasta = PASTA_LOGICA_ANEXO[nome_modelo]
+        for coluna in COLUNAS_ANEXO[nome_modelo]:
+            atributo = getattr(modelo, coluna)
+            legados = modelo.query.filter(atributo.isnot(None), atributo != '').order_by(modelo.id)
+            ultimo_id = 0
+            while True:
+                registros = [r for r in legados.filter(modelo.id > ultimo_id).limit(lote)]
+                if not registros:
+                    break
+                ultimo_id = registros[-1].id
+                for registro in registros:
+                    nome_antigo = getattr(registro, coluna)
+                    if PADRAO_NOME_CONTEUDO.match(nome_antigo):
+                        continue
+                    origem = localizar_anexo(pasta_do_anexo(pasta, nome_antigo), nome_antigo)
+                    if not os.path.exists(origem):
+                        ausentes += 1
+                        print(f"{nome_modelo} #{registro.id}: arquivo '{nome_antigo}' não encontrado. Pulando.")
+                        continue
+                    nome = f"{hash_de_arquivo(origem)}.{nome_antigo.rsplit('.', 1)[-1].lower()}"
+                    destino = caminho_fragmentado(app.config['UPLOAD_FOLDER_CONTEUDO'], nome)
+                    if nome in vistos or os.path.exists(destino):
+                        repetidos += 1
+                        economizados += os.path.getsize(origem)
+                    vistos.add(nome)
+                    movidos += 1
+                    if dry_run:
+                        continue
+                    # O arquivo entra no armazenamento antes do commit; o antigo sai depois dele.
+                    # Sem copiar a data antiga: até o commit o arquivo não é referenciado, e o
+                    # reconciliador só deixa em paz os arquivos recentes.
+                    if not os.path.exists(destino):
+                        os.makedirs(os.path.dirname(destino), exist_ok=True)
+                        shutil.copyfile(origem, destino)
+                    else:
+                        os.utime(destino)
+                    db.session.info.setdefault('tamanhos_upload', {})[nome] = os.path.getsize(destino)
+                    setattr(registro, coluna, nome)
+                    if eh_imagem(destino):
+                        agendar_derivados(app.config['UPLOAD_FOLDER_CONTEUDO'], nome)
+                if not dry_run:
+                    db.session.commit()
+    db.session.info.pop('auditoria_suspensa', None)
+    # As duas threads são daemon: sem esperar, miniaturas e remoções dos arquivos antigos
+    # agendadas pelos commits morreriam com o comando.
+    fila_derivados.join()
+    fila_manutencao.join()
+    prefixo = "[dry-run] " if dry_run else ""
+    print(f"{prefixo}{movidos} anexo(s) migrado(s), {repetidos} repetido(s) "
+          f"({economizados / (1024 * 1024):.1f} MB economizados), {ausentes} ausente(s).")
+
+@anexos_cli.command('fragmentar')
+@click.option('--lote', default=500, show_default=True, help='Arquivos movidos por lote.')
+@click.option('--pausa', default=0.5, show_default=True, help='Segundos de espera entre lotes, para não disputar disco com a aplicação.')
+@click.option('--limite', default=0, help='Para depois de mover N arquivos (0 = todos); rodar de novo continua de onde parou.')
+def anexos_fragmentar(lote, pausa, limite):
+    """Move os arquivos da raiz das pastas de upload para as subpastas <ab>/<cd>/."""
+    # Pode rodar com a aplicação no ar: localizar_anexo acha o arquivo antes e depois do
+    # os.replace, e arquivos novos já nascem nas subpastas. Só o que ainda está na raiz é
+    # visitado, então uma execução interrompida é retomada simplesmente rodando de novo.
+    movidos = ocupados = 0
+    pastas = [app.config['UPLOAD_FOLDER_ATIVIDADES'], app.config['UPLOAD_FOLDER_PEDIDOS'],
+              app.config['UPLOAD_FOLDER_CONTEUDO']]
+    for pasta in pastas + [os.path.join(pasta, '_derivados') for pasta in pastas]:
+        if not os.path.isdir(pasta):
+            continue
+        derivados = os.path.basename(pasta) == '_derivados'
+        with os.scandir(pasta) as entradas:
+            nomes = [e.name for e in entradas if e.is_file() and not e.name.startswith('.') and not e.name.endswith('.tmp')]
+        for inicio in range(0, len(nomes), lote):
+            for nome in nomes[inicio:inicio + lote]:
+                # Derivados ficam nas mesmas subpastas do original (<nome>.<tipo>.jpg).
+                destino = caminho_fragmentado(pasta, nome, chave=nome.rsplit('.', 2)[0] if derivados else None)
+                try:
+                    os.makedirs(os.path.dirname(destino), exist_ok=True)
+                    os.replace(os.path.join(pasta, nome), destino)
+                    movidos += 1
+                except FileNotFoundError:
+                    pass  # removido ou já movido por outro processo
+                except OSError as e:
+                    # No Windows, arquivo aberto (sendo enviado) não pode ser movido; fica para a próxima.
+                    ocupados += 1
+                    app.logger.warning(f"Não foi possível mover {nome}: {e}")
+                if limite and movidos >= limite:
+                    break
+            print(f"{os.path.relpath(pasta, UPLOAD_BASE_FOLDER)}: {min(inicio + lote, len(nomes))}/{len(nomes)}")
+            if limite and movidos >= limite:
+                print(f"Limite atingido: {movidos} arquivo(s) movido(s). Rode de novo para continuar.")
+                return
+            time.sleep(pausa)
+    print(f"{movidos} arquivo(s) movido(s), {ocupados} em uso (rode de novo para tentar outra vez).")
+
+
+# --- CONTADORES DO PAINEL ---
+# Cada atividade/pedido contribui com +1 em um conjunto de chaves de contador_painel:
+#   status:<id>                      todas as atividades
+#   prioridade:<id>, centro_de_custo:<nome>   só atividades em aberto
+#   pedidos, entrega:<AAAA-MM-DD>    todos os pedidos / por data prevista de entrega
+# Os eventos de flush comparam as chaves de cada linha antes e depois da gravação e aplicam
+# só as diferenças, na mesma transação. Pedidos atrasados dependem da data de hoje: o contador
+# 'atrasados' vale para entregas anteriores a 'atrasados_ate' (ordinal de uma data) e é avançado
+# uma vez por dia somando os buckets entrega:<data> que venceram (avancar_pedidos_atrasados).
+CAMPOS_CONTADOS = {
+    'Atividade': ('status_id', 'prioridade_id', 'centro_de_custo'),
+    'PedidoProducao': ('data_prevista_entrega',),
+}
+
+def chaves_de_contador(nome_modelo, valores):
+    """Chaves de contador_painel para as quais uma linha contribui com +1."""
+    if nome_modelo == 'Atividade':
+        status_id, prioridade_id, centro_de_custo = valores
+        chaves = {f'status:{status_id}'}
+        if status_id != StatusAtividade.CONCLUIDO:
+            chaves |= {f'prioridade:{prioridade_id}', f'centro_de_custo:{centro_de_custo}'}
+        return chaves
+    (data_prevista_entrega,) = valores
+    chaves = {'pedidos'}
+    if data_prevista_entrega:
+        chaves.add(f'entrega:{data_prevista_entrega.isoformat()}')
+    return chaves
+
+@event.listens_for(db.session, 'before_flush')
+def registrar_contadores_antes_do_flush(session, flush_context, instances):
+    # O estado "antes" é lido do banco: o histórico dos atributos não guarda o valor antigo de
+    # objetos expirados, e alterações feitas pelos relacionamentos (ex.: atividade.status_info)
+    # só chegam às colunas durante o flush.
+    antes = session.info.setdefault('contadores_antes', {})
+    pendentes = {}
+    for obj in list(session.dirty) + list(session.deleted):
+        nome_modelo = type(obj).__name__
+        if nome_modelo in CAMPOS_CONTADOS and obj not in antes and obj.id is not None:
+            pendentes.setdefault(type(obj), {})[obj.id] = obj
+    for modelo, objetos in pendentes.items():
+        campos = CAMPOS_CONTADOS[modelo.__name__]
+        colunas = [getattr(modelo, campo) for campo in campos]
+        with session.no_autoflush:
+            linhas = session.execute(db.select(modelo.id, *colunas).where(modelo.id.in_(list(objetos)))).all()
+        for linha in linhas:
+            antes[objetos[linha[0]]] = chaves_de_contador(modelo.__name__, tuple(linha[1:]))
+
+@event.listens_for(db.session, 'after_flush')
+def atualizar_contadores_apos_flush(session, flush_context):
+    antes = session.info.pop('contadores_antes', {})
+    deltas = Counter()
+    for obj in session.new:
+        nome_modelo = type(obj).__name__
+        if nome_modelo in CAMPOS_CONTADOS:
+            deltas.update(chaves_de_contador(nome_modelo, [getattr(obj, c) for c in CAMPOS_CONTADOS[nome_modelo]]))
+    for obj, chaves_antes in antes.items():
+        deltas.subtract(chaves_antes)
+        if obj not in session.deleted:
+            nome_modelo = type(obj).__name__
+            deltas.update(chaves_de_contador(nome_modelo, [getattr(obj, c) for c in CAMPOS_CONTADOS[nome_modelo]]))
+    deltas = {chave: delta for chave, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    conexao = session.connection()
+    # Entregas que já vencem antes de 'atrasados_ate' também mexem no contador de atrasados.
+    atrasados_ate = conexao.execute(db.text(
+        "SELECT valor FROM contador_painel WHERE chave = 'atrasados_ate'")).scalar()
+    if atrasados_ate is not None:
+        limite = f'entrega:{date.fromordinal(atrasados_ate).isoformat()}'
+        atrasados = sum(delta for chave, delta in deltas.items() if chave.startswith('entrega:') and chave < limite)
+        if atrasados:
+            deltas['atrasados'] = deltas.get('atrasados', 0) + atrasados
+    conexao.execute(db.text(
+        "INSERT INTO contador_painel (chave, valor) VALUES (:chave, :delta) "
+        "ON CONFLICT (chave) DO UPDATE SET valor = valor + excluded.valor"),
+        [{'chave': chave, 'delta': delta} for chave, delta in deltas.items()])
+
+def avancar_pedidos_atrasados():
+    """Soma a 'atrasados' os buckets de entrega que venceram desde o último avanço (no máximo uma vez por dia)."""
+    hoje = date.today()
+    atrasados_ate = db.session.query(ContadorPainel.valor).filter_by(chave='atrasados_ate').scalar()
+    if atrasados_ate == hoje.toordinal():
+        return
+    try:
+        # Compare-and-set: só quem mover 'atrasados_ate' soma os buckets; o lock de escrita do
+        # SQLite vale até o commit, então nenhum flush grava entre a soma e o avanço.
+        if atrasados_ate is None:
+            avancou = db.session.execute(db.text(
+                "INSERT OR IGNORE INTO contador_painel (chave, valor) VALUES ('atrasados_ate', :hoje)"),
+                {'hoje': hoje.toordinal()}).rowcount
+            inicio = date.min
+        else:
+            avancou = db.session.execute(update(ContadorPainel)
+                .where(ContadorPainel.chave == 'atrasados_ate', ContadorPainel.valor == atrasados_ate)
+                .values(valor=hoje.toordinal())).rowcount
+            inicio = date.fromordinal(atrasados_ate)
+        if avancou:
+            vencidos = db.session.query(func.coalesce(func.sum(ContadorPainel.valor), 0)).filter(
+                ContadorPainel.chave >= f'entrega:{inicio.isoformat()}',
+                ContadorPainel.chave < f'entrega:{hoje.isoformat()}').scalar()
+            db.session.execute(db.text(
+                "INSERT INTO contador_painel (chave, valor) VALUES ('atrasados', :vencidos) "
+                "ON CONFLICT (chave) DO UPDATE SET valor = valor + excluded.valor"), {'vencidos': vencidos})
+        db.session.commit()
+    except OperationalError:
+        # Outro processo está gravando; o avanço fica para a próxima leitura.
+        db.session.rollback()
+
+def contadores_painel():
+    """Lê os contadores do dashboard (sem GROUP BY nas tabelas de atividades/pedidos)."""
+    avancar_pedidos_atrasados()
+    linhas = db.session.query(ContadorPainel.chave, ContadorPainel.valor).filter(
+        or_(ContadorPainel.chave < 'entrega:', ContadorPainel.chave >= 'entrega;'),
+        ContadorPainel.valor != 0).all()
+    contadores = {'status': {}, 'prioridade': {}, 'centro_de_custo': {}, 'pedidos': 0, 'atrasados': 0}
+    for chave, valor in linhas:
+        grupo, _, item = chave.partition(':')
+        if grupo in ('status', 'prioridade'):
+            contadores[grupo][int(item)] = valor
+        elif grupo == 'centro_de_custo':
+            contadores[grupo][item] = valor
+        elif grupo in ('pedidos', 'atrasados'):
+            contadores[grupo] = valor
+    return contadores
+
+def recalcular_contadores():
+    """Reconstrói contador_painel do zero com GROUP BY (reparo; o uso normal é incremental)."""
+    db.session.execute(db.delete(ContadorPainel))
+    abertas = Atividade.status_id != StatusAtividade.CONCLUIDO
+    consultas = [
+        ('status', db.session.query(Atividade.status_id, func.count()).group_by(Atividade.status_id)),
+        ('prioridade', db.session.query(Atividade.prioridade_id, func.count()).filter(abertas).group_by(Atividade.prioridade_id)),
+        ('centro_de_custo', db.session.query(Atividade.centro_de_custo, func.count()).filter(abertas).group_by(Atividade.centro_de_custo)),
+        ('entrega', db.session.query(PedidoProducao.data_prevista_entrega, func.count())
+            .filter(PedidoProducao.data_prevista_entrega.isnot(None)).group_by(PedidoProducao.data_prevista_entrega)),
+    ]
+    for grupo, consulta in consultas:
+        for item, quantidade in consulta:
+            item = item.isoformat() if isinstance(item, date) else item
+            db.session.add(ContadorPainel(chave=f'{grupo}:{item}', valor=quantidade))
+    db.session.add(ContadorPainel(chave='pedidos', valor=PedidoProducao.query.count()))
+    hoje = date.today()
+    db.session.add(ContadorPainel(chave='atrasados_ate', valor=hoje.toordinal()))
+    db.session.add(ContadorPainel(chave='atrasados', valor=PedidoProducao.query.filter(
+        PedidoProducao.data_prevista_entrega < hoje).count()))
+    db.session.commit()
+
+painel_cli = AppGroup('painel', help='Contadores do dashboard.')
+
+@painel_cli.command('recalcular')
+def painel_recalcular():
+    """Reconstrói os contadores do dashboard a partir das tabelas."""
+    recalcular_contadores()
+    print("Contadores do painel recalculados.")
+
+app.cli.add_command(painel_cli)
+
+
+# --- HISTÓRICO AUTOMÁTICO ---
+# Gravações dos modelos de AUDITORIA viram linhas de historico_modificacao no mesmo flush, sem
+# código nas rotas. O before_flush compara o histórico de cada atributo (valor carregado x valor
+# novo; se o antigo não estava carregado, ele é lido do banco numa consulta por modelo) e o
+# after_flush insere todas as linhas de uma vez, quando os ids dos registros novos já existem.
+# Toda coluna e relacionamento N:1 que não esteja em 'ignorar' é auditado, inclusive colunas
+# novas; o rótulo padrão é o nome do atributo. 'dono' é o atributo que leva à atividade dona do
+# histórico (None: o próprio registro); 'criacao'/'exclusao' geram as linhas de inclusão/remoção.
+AUDITORIA = {
+    'Atividade': {
+        'dono': None,
+        'ignorar': {'id', 'data_criacao', 'responsavel_atual', 'versao'},
+        'rotulos': {
+            'nome_atividade': 'Nome da Atividade', 'prioridade_info': 'Prioridade',
+            'centro_de_custo': 'Centro de Custo', 'status_info': 'Status',
+            'observacoes': 'Observações', 'pedido': 'Pedido',
+            'local_de_entrega': 'Local de Entrega', 'solicitante': 'Solicitante',
+            'obra_destino': 'Obra / Destino', 'imagem_anexo': 'Anexo',
+        },
+        'criacao': lambda atividade: [("Criação da Atividade", None, f"Atividade '{atividade.nome_atividade}' criada.")]
+                                     + ([("Anexo", None, "Imagem adicionada.")] if atividade.imagem_anexo else []),
+    },
+    'Anexo': {
+        'dono': 'atividade',
+        'ignorar': {'id', 'nome_arquivo', 'tamanho', 'enviado_por', 'data_envio', 'atividade', 'pedido_producao'},
+        'rotulos': {'nome_original': 'Nome do Anexo'},
+        'criacao': lambda anexo: [("Anexo adicionado", None, anexo.nome_original)],
+        'exclusao': lambda anexo: [("Anexo removido", anexo.nome_original, None)],
+    },
+}
+_atributos_auditados = {}
+
+def atributos_auditados(modelo):
+    """{atributo: coluna no banco} auditados do modelo; relacionamentos N:1 no lugar da chave estrangeira."""
+    if modelo not in _atributos_auditados:
+        mapper = inspect(modelo)
+        relacoes = [r for r in mapper.relationships if r.direction.name == 'MANYTOONE' and len(r.local_columns) == 1]
+        chaves_estrangeiras = {coluna.key for r in relacoes for coluna in r.local_columns}
+        atributos = {a.key: a.columns[0] for a in mapper.column_attrs if a.columns[0].key not in chaves_estrangeiras}
+        atributos.update({r.key: next(iter(r.local_columns)) for r in relacoes})
+        ignorar = AUDITORIA[modelo.__name__]['ignorar']
+        _atributos_auditados[modelo] = {chave: coluna for chave, coluna in atributos.items() if chave not in ignorar}
+    return _atributos_auditados[modelo]
+
+def autor_da_alteracao(session):
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.nome
+    return session.info.get('autor', 'Sistema')
+
+def dono_do_historico(obj):
+    atributo = AUDITORIA[type(obj).__name__]['dono']
+    return getattr(obj, atributo) if atributo else obj
+
+def mudanca_de_atributo(obj, atributo, antigo, novo):
+    """(campo, antigo, novo) para o histórico, ou None quando o valor exibido não mudou."""
+    antigo = None if antigo is None else str(antigo)
+    novo = None if novo is None else str(novo)
+    # Mesma regra dos formulários: vazio e nulo são o mesmo valor.
+    if (antigo or '') == (novo or ''):
+        return None
+    return AUDITORIA[type(obj).__name__]['rotulos'].get(atributo, atributo), antigo, novo
+
+@event.listens_for(db.session, 'before_flush')
+def registrar_historico_antes_do_flush(session, flush_context, instances):
+    if session.info.get('auditoria_suspensa'):
+        return
+    pendentes = session.info.setdefault('historico_pendente', [])
+    autor = autor_da_alteracao(session)
+    sem_valor_antigo = []  # (obj, atributo, valor novo) cujo valor antigo não estava carregado
+    with session.no_autoflush:
+        for obj in session.new:
+            config = AUDITORIA.get(type(obj).__name__)
+            dono = dono_do_historico(obj) if config and 'criacao' in config else None
+            if dono is not None:
+                pendentes.extend((dono, campo, antigo, novo, autor) for campo, antigo, novo in config['criacao'](obj))
+        for obj in session.deleted:
+            config = AUDITORIA.get(type(obj).__name__)
+            dono = dono_do_historico(obj) if config and 'exclusao' in config else None
+            if dono is not None and dono not in session.deleted:
+                pendentes.extend((dono, campo, antigo, novo, autor) for campo, antigo, novo in config['exclusao'](obj))
+        for obj in session.dirty:
+            if type(obj).__name__ not in AUDITORIA or obj.id is None or obj in session.deleted:
+                continue
+            dono = dono_do_historico(obj)
+            if dono is None:
+                continue
+            estado = inspect(obj)
+            for atributo in atributos_auditados(type(obj)):
+                historico = estado.attrs[atributo].history
+                if not historico.added:
+                    continue
+                if historico.deleted:
+                    mudanca = mudanca_de_atributo(obj, atributo, historico.deleted[0], historico.added[0])
+                    if mudanca:
+                        pendentes.append((dono, *mudanca, autor))
+                else:
+                    sem_valor_antigo.append((obj, dono, atributo, historico.added[0]))
+
+        if sem_valor_antigo:
+            por_modelo = {}
+            for obj, *_ in sem_valor_antigo:
+                por_modelo.setdefault(type(obj), set()).add(obj.id)
+            valores = {}
+            for modelo, ids in por_modelo.items():
+                colunas = atributos_auditados(modelo)
+                linhas = session.execute(db.select(modelo.id, *colunas.values()).where(modelo.id.in_(ids))).all()
+                valores.update(((modelo, linha[0]), dict(zip(colunas, linha[1:]))) for linha in linhas)
+            for obj, dono, atributo, novo in sem_valor_antigo:
+                antigo = valores.get((type(obj), obj.id), {}).get(atributo)
+                relacao = inspect(type(obj)).relationships.get(atributo)
+                if relacao is not None and antigo is not None:
+                    antigo = session.get(relacao.mapper.class_, antigo)
+                mudanca = mudanca_de_atributo(obj, atributo, antigo, novo)
+                if mudanca:
+                    pendentes.append((dono, *mudanca, autor))
+
+@event.listens_for(db.session, 'after_flush')
+def gravar_historico_apos_flush(session, flush_context):
+    pendentes = session.info.pop('historico_pendente', None)
+    if not pendentes:
+        return
+    agora = datetime.utcnow()
+    session.connection().execute(HistoricoModificacao.__table__.insert(), [
+        {'atividade_id': dono.id, 'campo_alterado': campo, 'valor_antigo': antigo, 'valor_novo': novo,
+         'modificado_por': autor, 'data_modificacao': agora}
+        for dono, campo, antigo, novo, autor in pendentes])
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def descartar_historico_pendente(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop('historico_pendente', None)
+
+
+# --- CACHE DE FRAGMENTOS ---
+# Linhas das tabelas e blocos de detalhes são renderizados uma vez por (fragmento, id, versao) e
+# reaproveitados como string. A versão vem do banco, então todos os processos enxergam a mesma
+# invalidação; o cache em si é local ao processo e limitado por CACHE_FRAGMENTOS_MAX (LRU).
+# Uma linha nova começa na versao_dados corrente, que já passou de todas as versões de linhas
+# gravadas antes (cada flush incrementa as duas): se o SQLite reutilizar o id de uma linha
+# excluída, a nova não herda o HTML guardado para a antiga.
+FRAGMENTOS = {
+    'linha_atividade': ('linha_atividade.html', 'atividade'),
+    'linha_pedido': ('linha_pedido.html', 'pedido'),
+    'linha_pedido_resumo': ('linha_pedido_resumo.html', 'pedido'),
+    'campos_atividade': ('campos_atividade.html', 'atividade'),
+    'campos_pedido': ('campos_pedido.html', 'pedido'),
+}
+
+class CacheFragmentos:
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self.itens = OrderedDict()
+        self.trava = threading.Lock()
+        self.acertos = self.faltas = self.despejos = 0
+
+    def obter(self, chave, versao):
+        with self.trava:
+            item = self.itens.get(chave)
+            if item is not None and item[0] == versao:
+                self.itens.move_to_end(chave)
+                self.acertos += 1
+                return item[1]
+            self.faltas += 1
+            return None
+
+    def guardar(self, chave, versao, html):
+        with self.trava:
+            self.itens[chave] = (versao, html)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.maximo:
+                self.itens.popitem(last=False)
+                self.despejos += 1
+
+    def metricas(self):
+        with self.trava:
+            return {'itens': len(self.itens), 'maximo': self.maximo, 'acertos': self.acertos,
+                    'faltas': self.faltas, 'despejos': self.despejos}
+
+cache_fragmentos = CacheFragmentos(app.config['CACHE_FRAGMENTOS_MAX'])
+cache_emails = CacheFragmentos(app.config['CACHE_EMAILS_MAX'])
+
+@app.template_global()
+def fragmento(nome, obj):
+    """HTML de um fragmento para o objeto, do cache quando a versão da linha não mudou."""
+    chave = (nome, obj.id)
+    html = cache_fragmentos.obter(chave, obj.versao)
+    if html is None:
+        arquivo, variavel = FRAGMENTOS[nome]
+        html = Markup(app.jinja_env.get_template(arquivo).render({variavel: obj}))
+        cache_fragmentos.guardar(chave, obj.versao, html)
+    return html
+
+@event.listens_for(db.session, 'before_flush')
+def incrementar_versoes(session, flush_context, instances):
+    # Incremento feito no UPDATE (versao = versao + 1), para não depender do valor carregado pelo processo.
+    alterados = {obj for obj in session.dirty
+                 if isinstance(obj, (Atividade, PedidoProducao)) and session.is_modified(obj, include_collections=False)}
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, HistoricoModificacao):
+                atividade = obj.atividade or session.get(Atividade, obj.atividade_id)
+                if atividade is not None and atividade not in session.new:
+                    alterados.add(atividade)
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, Anexo) and obj.dono is not None and obj.dono not in session.new:
+                alterados.add(obj.dono)
+    for obj in alterados:
+        if obj not in session.deleted:
+            obj.versao = type(obj).versao + 1
+    versao_atual = func.coalesce(db.select(VersaoDados.versao).filter_by(id=1).scalar_subquery(), 1)
+    for obj in session.new:
+        if isinstance(obj, (Atividade, PedidoProducao)):
+            obj.versao = versao_atual
+
+
+# --- RESPOSTAS CONDICIONAIS ---
+# As páginas de lista e de detalhes dependem só dos dados, do usuário logado e do dia (contadores
+# de atrasados, ano no rodapé). Qualquer flush que grave esses dados incrementa versao_dados; a
+# ETag é derivada dela, então um If-None-Match que confere responde 304 antes das consultas e
+# do template. Last-Modified usa o horário da última gravação, que vale para todas as páginas.
+MODELOS_VERSIONADOS = ('Anexo', 'Atividade', 'HistoricoModificacao', 'PedidoProducao', 'Prioridade', 'StatusAtividade')
+
+@event.listens_for(db.session, 'after_flush')
+def incrementar_versao_dados(session, flush_context):
+    gravados = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(type(obj).__name__ in MODELOS_VERSIONADOS for obj in gravados):
+        session.connection().execute(update(VersaoDados).where(VersaoDados.id == 1)
+                                     .values(versao=VersaoDados.versao + 1, modificado_em=datetime.utcnow()))
+
+def resposta_condicional(view):
+    """Adiciona ETag/Last-Modified à página e responde 304 quando o navegador já tem a versão atual."""
+    @wraps(view)
+    def envoltorio(*args, **kwargs):
+        # Mensagens flash pendentes precisam ser renderizadas; a resposta não pode vir do cache.
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+        linha = db.session.execute(db.select(VersaoDados.versao, VersaoDados.modificado_em).filter_by(id=1)).first()
+        if linha is None:
+            return view(*args, **kwargs)
+        identidade = '|'.join(str(parte) for parte in (
+            request.full_path, linha.versao, current_user.get_id(), current_user.nome, current_user.is_admin, date.today()))
+        etag = hashlib.sha1(identidade.encode()).hexdigest()
+        modificado_em = linha.modificado_em.replace(microsecond=0, tzinfo=timezone.utc)
+
+        if request.if_none_match:
+            nao_modificado = request.if_none_match.contains(etag)
+        else:
+            nao_modificado = request.if_modified_since is not None and modificado_em <= request.if_modified_since
+        resposta = make_response('', 304) if nao_modificado else make_response(view(*args, **kwargs))
+        resposta.set_etag(etag)
+        resposta.last_modified = modificado_em
+        # 'private, no-cache': o navegador guarda a página, mas revalida a cada acesso.
+        resposta.cache_control.private = True
+        resposta.cache_control.no_cache = True
+        return resposta
+    return envoltorio
+
+
+# --- VERIFICAÇÃO DE SENHAS ---
+# Cada verificação PBKDF2 custa centenas de milissegundos de CPU. Ela roda num pool de processos
+# limitado, para não disputar o GIL com as outras requisições, e no máximo SENHA_FILA_MAX
+# verificações esperam ao mesmo tempo; acima disso o login responde 503 na hora.
+class FilaDeSenhasCheia(Exception):
+    pass
+
+_pool_senhas = None
+_trava_pool_senhas = threading.Lock()
+vagas_senhas = threading.BoundedSemaphore(app.config['SENHA_FILA_MAX'])
+
+def obter_pool_senhas():
+    """Cria o pool na primeira verificação (depois de qualquer fork do servidor)."""
+    global _pool_senhas
+    if app.config['SENHA_PROCESSOS'] <= 0:
+        return None
+    with _trava_pool_senhas:
+        if _pool_senhas is None:
+            _pool_senhas = ProcessPoolExecutor(max_workers=app.config['SENHA_PROCESSOS'])
+        return _pool_senhas
+
+def executar_hash(funcao, *args):
+    """Executa check_password_hash/generate_password_hash no pool, respeitando o limite da fila."""
+    global _pool_senhas
+    if not vagas_senhas.acquire(blocking=False):
+        raise FilaDeSenhasCheia()
+    try:
+        pool = obter_pool_senhas()
+        if pool is None:
+            return funcao(*args)
+        try:
+            return pool.submit(funcao, *args).result(timeout=app.config['SENHA_TIMEOUT'])
+        except TempoEsgotado:
+            raise FilaDeSenhasCheia()
+        except BrokenProcessPool:
+            with _trava_pool_senhas:
+                _pool_senhas = None
+            return funcao(*args)
+    finally:
+        vagas_senhas.release()
+
+def atualizar_hash_se_necessario(usuario, senha):
+    """Regrava o hash com SENHA_METODO quando o armazenado usa outro custo (senha já conferida)."""
+    metodo = app.config['SENHA_METODO']
+    if usuario.senha_hash.split('$', 1)[0] == metodo:
+        return
+    try:
+        usuario.senha_hash = executar_hash(generate_password_hash, senha, metodo)
+        db.session.commit()
+    except FilaDeSenhasCheia:
+        # Fica para o próximo login; a senha atual continua válida.
+        pass
+
+class LimitadorLogin:
+    """
+    Token bucket em memória por chave ('login:<login>' ou 'ip:<endereço>'). Cada tentativa gasta
+    uma ficha; cada falha além de `falhas_livres` bloqueia a chave por 2, 4, 8... segundos
+    (até `bloqueio_max`; falhas_livres=None desliga o bloqueio). Um login correto zera as falhas.
+    """
+    def __init__(self, rajada, por_minuto, falhas_livres, bloqueio_max, maximo):
+        self.rajada = rajada
+        self.recarga = por_minuto / 60
+        self.falhas_livres = falhas_livres
+        self.bloqueio_max = bloqueio_max
+        self.maximo = maximo
+        self.chaves = OrderedDict()  # chave -> [fichas, atualizado_em, falhas, bloqueado_ate]
+        self.trava = threading.Lock()
+        self.permitidas = self.recusadas = self.falhas = 0
+
+    def _estado(self, chave, agora):
+        estado = self.chaves.get(chave)
+        if estado is None:
+            estado = self.chaves[chave] = [float(self.rajada), agora, 0, 0.0]
+            while len(self.chaves) > self.maximo:
+                self.chaves.popitem(last=False)
+        else:
+            estado[0] = min(self.rajada, estado[0] + (agora - estado[1]) * self.recarga)
+            estado[1] = agora
+            self.chaves.move_to_end(chave)
+        return estado
+
+    def admitir(self, chaves):
+        """Gasta uma ficha de cada chave; devolve 0 ou os segundos até a próxima tentativa permitida."""
+        agora = time.monotonic()
+        with self.trava:
+            estados = [self._estado(chave, agora) for chave in chaves]
+            espera = 0.0
+            for fichas, _, _, bloqueado_ate in estados:
+                espera = max(espera, bloqueado_ate - agora, (1 - fichas) / self.recarga if fichas < 1 else 0)
+            if espera > 0:
+                self.recusadas += 1
+                return math.ceil(espera)
+            for estado in estados:
+                estado[0] -= 1
+            self.permitidas += 1
+            return 0
+
+    def registrar_falha(self, chaves):
+        agora = time.monotonic()
+        with self.trava:
+            self.falhas += 1
+            if self.falhas_livres is None:
+                return
+            for chave in chaves:
+                estado = self._estado(chave, agora)
+                estado[2] += 1
+                excesso = estado[2] - self.falhas_livres
+                if excesso > 0:
+                    estado[3] = agora + min(2 ** excesso, self.bloqueio_max)
+
+    def registrar_sucesso(self, chaves):
+        with self.trava:
+            for chave in chaves:
+                estado = self.chaves.get(chave)
+                if estado is not None:
+                    estado[2], estado[3] = 0, 0.0
+
+    def metricas(self):
+        agora = time.monotonic()
+        with self.trava:
+            return {'chaves': len(self.chaves), 'maximo': self.maximo,
+                    'bloqueadas': sum(1 for estado in self.chaves.values() if estado[3] > agora),
+                    'permitidas': self.permitidas, 'recusadas': self.recusadas, 'falhas': self.falhas}
+
+limitador_login = LimitadorLogin(app.config['LOGIN_RAJADA'], app.config['LOGIN_POR_MINUTO'],
+                                 app.config['LOGIN_FALHAS_LIVRES'], app.config['LOGIN_BLOQUEIO_MAX'],
+                                 app.config['LOGIN_LIMITADOR_MAX'])
+limitador_ip = LimitadorLogin(app.config['LOGIN_IP_RAJADA'], app.config['LOGIN_IP_POR_MINUTO'],
+                              None, 0, app.config['LOGIN_LIMITADOR_MAX'])
+
+senha_cli = AppGroup('senha', help='Custo do hash de senhas.')
+
+@senha_cli.command('benchmark')
+@click.option('--alvo-ms', default=250, show_default=True, help='Latência desejada por verificação.')
+@click.option('--repeticoes', default=3, show_default=True)
+def senha_benchmark(alvo_ms, repeticoes):
+    """Mede o PBKDF2 nesta máquina e sugere um SENHA_METODO para a latência alvo."""
+    def medir(metodo):
+        hash_ = generate_password_hash('benchmark', metodo)
+        inicio = time.perf_counter()
+        for _ in range(repeticoes):
+            check_password_hash(hash_, 'benchmark')
+        return (time.perf_counter() - inicio) / repeticoes * 1000
+
+    base = 100_000
+    ms_base = medir(f'pbkdf2:sha256:{base}')
+    iteracoes = max(base, int(base * alvo_ms / ms_base) // 10_000 * 10_000)
+    print(f"pbkdf2:sha256:{base}: {ms_base:.1f} ms por verificação")
+    print(f"Atual ({app.config['SENHA_METODO']}): {medir(app.config['SENHA_METODO']):.1f} ms por verificação")
+    sugerido = f'pbkdf2:sha256:{iteracoes}'
+    ms_sugerido = medir(sugerido)
+    processos = max(app.config['SENHA_PROCESSOS'], 1)
+    print(f"Sugerido para ~{alvo_ms} ms: SENHA_METODO={sugerido} ({ms_sugerido:.1f} ms medidos)")
+    print(f"Com {processos} processo(s) no pool: até ~{processos * 1000 / ms_sugerido:.1f} logins/s.")
+
+app.cli.add_command(senha_cli)
 
 
 # --- ROTAS DA APLICAÇÃO ---
 
+UM_ANO = 365 * 24 * 3600
+
 @app.route('/uploads/<folder>/<path:filename>')
 def uploaded_file(folder, filename):
-    if folder == 'atividades':
-        return send_from_directory(app.config['UPLOAD_FOLDER_ATIVIDADES'], filename)
-    elif folder == 'pedidos':
-        return send_from_directory(app.config['UPLOAD_FOLDER_PEDIDOS'], filename)
-    else:
+    # Todo nome de anexo é único (hash do conteúdo ou uuid) e nunca é regravado com outro conteúdo,
+    # então a resposta pode ficar um ano no cache do navegador sem revalidação.
+    pasta = pasta_do_anexo(folder, filename)
+    subpasta, _, nome_base = filename.rpartition('/')
+    if pasta is None or subpasta not in ('', '_derivados') or safe_join(pasta, nome_base) is None:
         abort(404)
+    # A URL não inclui as subpastas <ab>/<cd>/; o arquivo é localizado aqui.
+    provisorio = False
+    if subpasta:
+        original = nome_base.rsplit('.', 2)[0]
+        caminho = localizar_anexo(os.path.join(pasta, subpasta), nome_base, chave=original)
+        if not os.path.isfile(caminho) and os.path.isfile(localizar_anexo(pasta, original)):
+            # Versão reduzida ainda não gerada: entrega a original, sem cache longo, e garante
+            # que ela esteja na fila (imagens enviadas antes das miniaturas existirem).
+            caminho, nome_base, provisorio = localizar_anexo(pasta, original), original, True
+            agendar_derivados(pasta, original)
+    else:
+        caminho = localizar_anexo(pasta, nome_base)
+    etag = nome_base if PADRAO_NOME_CONTEUDO.match(nome_base) and not provisorio else None
+    if etag and request.if_none_match.contains(etag):
+        resposta = make_response('', 304)
+    elif app.config['ANEXOS_OFFLOAD'] == 'x-accel':
+        if not os.path.isfile(caminho):
+            abort(404)
+        resposta = make_response('')
+        resposta.headers['X-Accel-Redirect'] = app.config['ANEXOS_X_ACCEL_PREFIXO'] + \
+            os.path.relpath(caminho, UPLOAD_BASE_FOLDER).replace(os.sep, '/')
+        resposta.mimetype = mimetypes.guess_type(nome_base)[0] or 'application/octet-stream'
+    else:
+        # conditional=True (padrão): If-None-Match/If-Modified-Since e Range/If-Range (206) no Werkzeug.
+        resposta = send_from_directory(os.path.dirname(caminho), nome_base, etag=etag or True, max_age=UM_ANO)
+    if etag:
+        resposta.set_etag(etag)
+    if provisorio:
+        resposta.cache_control.no_cache = True
+        resposta.cache_control.max_age = 0
+        return resposta
+    resposta.cache_control.public = True
+    resposta.cache_control.max_age = UM_ANO
+    resposta.cache_control.immutable = True
+    return resposta
 
 @app.route('/')
 @login_required
+@resposta_condicional
 def index():
     ultimas_atividades = Atividade.query.order_by(Atividade.data_criacao.desc()).limit(5).all()
     ultimos_pedidos = PedidoProducao.query.order_by(PedidoProducao.data_criacao.desc()).limit(5).all()
-    return render_template('index.html', ultimas_atividades=ultimas_atividades, ultimos_pedidos=ultimos_pedidos)
+    return render_template('index.html', ultimas_atividades=ultimas_atividades, ultimos_pedidos=ultimos_pedidos,
+                           contadores=contadores_painel(), **opcoes_formulario_atividade())
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -120,12 +1955,26 @@ def login():
     if request.method == 'POST':
         login_input = request.form.get('login')
         senha_input = request.form.get('senha')
+        chaves_limite = (f"login:{(login_input or '').strip().lower()}",)
+        # O endereço é conferido antes: uma recusa por IP não gasta a ficha do login.
+        espera = limitador_ip.admitir((f'ip:{request.remote_addr}',)) or limitador_login.admitir(chaves_limite)
+        if espera:
+            flash(f'Muitas tentativas de login. Tente novamente em {espera} segundo(s).', 'danger')
+            return render_template('login.html'), 429, {'Retry-After': str(espera)}
         user_obj = User.query.filter_by(login=login_input).first()
-        if user_obj and check_password_hash(user_obj.senha_hash, senha_input):
+        try:
+            senha_ok = user_obj is not None and executar_hash(check_password_hash, user_obj.senha_hash, senha_input or '')
+        except FilaDeSenhasCheia:
+            flash('Muitos logins em andamento. Tente novamente em alguns segundos.', 'danger')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        if senha_ok:
+            limitador_login.registrar_sucesso(chaves_limite)
+            atualizar_hash_se_necessario(user_obj, senha_input)
             login_user(user_obj)
             next_page = request.args.get('next')
             return redirect(next_page or url_for('index'))
         else:
+            limitador_login.registrar_falha(chaves_limite)
             flash('Login ou senha inválidos.', 'danger')
     return render_template('login.html')
 
@@ -136,14 +1985,92 @@ def logout():
     flash('Você foi desconectado com sucesso.', 'success')
     return redirect(url_for('login'))
 
+@app.route('/admin/metricas')
+@login_required
+def metricas_processo():
+    """Métricas dos caches e do limitador de login deste processo."""
+    if not current_user.is_admin:
+        abort(403)
+    return jsonify(fragmentos=cache_fragmentos.metricas(), emails=cache_emails.metricas(), usuarios=cache_usuarios.metricas(),
+                   tokens=cache_tokens.metricas(), login=limitador_login.metricas(),
+                   login_ip=limitador_ip.metricas())
+
+# --- BUSCA ---
+# Tipos de registro codificados no rowid de busca_fts (ver migrations/0004_busca_fts.sql).
+TIPOS_BUSCA = {1: 'Atividade', 2: 'Pedido', 3: 'Histórico'}
+
+def montar_consulta_fts(termos):
+    """Converte o texto digitado em uma consulta FTS5 segura: cada palavra vira um prefixo entre aspas."""
+    return ' '.join(f'"{palavra}"*' for palavra in re.findall(r'\w+', termos))
+
+def destacar_trecho(trecho):
+    """Escapa o trecho devolvido pelo snippet() e troca os marcadores \\x02/\\x03 por <mark>."""
+    return Markup(str(escape(trecho or '')).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+@app.route('/busca')
+@login_required
+def busca():
+    termos = request.args.get('q', '').strip()
+    consulta = montar_consulta_fts(termos)
+    resultados, duracao_ms = [], None
+    if consulta:
+        inicio = time.perf_counter()
+        # O bm25 precisa avaliar todas as linhas encontradas antes do LIMIT. Para não pagar isso
+        # em termos que aparecem em milhares de registros, cada tipo de registro é ranqueado só a
+        # partir do menor rowid entre as suas ocorrências mais recentes (o FTS5 percorre rowids em
+        # ordem, barato). A janela é por tipo porque os rowids (id*4+tipo) se intercalam e o
+        # histórico, bem mais numeroso, tomaria a janela inteira de atividades e pedidos.
+        limite = app.config['ITENS_POR_PAGINA'] * 2
+        linhas = []
+        for tipo in TIPOS_BUSCA:
+            linhas += db.session.execute(db.text(
+                "SELECT rowid, titulo, atividade_id, "
+                "       snippet(busca_fts, -1, char(2), char(3), '…', 12) AS trecho, "
+                "       bm25(busca_fts, 10.0, 5.0, 2.0, 2.0, 2.0, 1.0, 0.0) AS nota "
+                "FROM busca_fts WHERE busca_fts MATCH :consulta AND rowid % 4 = :tipo "
+                "  AND rowid >= (SELECT coalesce(min(rowid), 0) FROM ("
+                "      SELECT rowid FROM busca_fts WHERE busca_fts MATCH :consulta AND rowid % 4 = :tipo "
+                "      ORDER BY rowid DESC LIMIT :janela)) "
+                "ORDER BY nota LIMIT :limite"),
+                {'consulta': consulta, 'tipo': tipo, 'janela': app.config['BUSCA_JANELA_RANKING'],
+                 'limite': limite}).all()
+        linhas = sorted(linhas, key=lambda linha: linha.nota)[:limite]
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        for rowid, titulo, atividade_id, trecho, _ in linhas:
+            tipo, registro_id = rowid % 4, rowid // 4
+            if tipo == 2:
+                url = url_for('detalhes_pedido', pedido_id=registro_id)
+            else:
+                url = url_for('detalhes_atividade', atividade_id=atividade_id)
+            if tipo == 3:
+                titulo = f"Histórico da Atividade #{atividade_id}"
+            resultados.append({'tipo': TIPOS_BUSCA[tipo], 'titulo': titulo, 'url': url,
+                               'trecho': destacar_trecho(trecho)})
+    return render_template('busca.html', termos=termos, resultados=resultados, duracao_ms=duracao_ms)
+
 # --- ROTAS DE ATIVIDADES DE ENGENHARIA ---
 
 @app.route('/atividades')
 @login_required
+@resposta_condicional
 def todas_atividades():
-    atividades_em_andamento = Atividade.query.filter(Atividade.status != 'Concluído').order_by(Atividade.prioridade, Atividade.data_criacao.desc()).all()
-    atividades_concluidas = Atividade.query.filter(Atividade.status == 'Concluído').order_by(Atividade.data_criacao.desc()).all()
-    return render_template('atividades.html', atividades_em_andamento=atividades_em_andamento, atividades_concluidas=atividades_concluidas)
+    # Cada painel tem o seu próprio cursor, para que paginar um não reinicie o outro.
+    cursor_andamento = request.args.get('cursor_andamento')
+    cursor_concluidas = request.args.get('cursor_concluidas')
+    limite = app.config['ITENS_POR_PAGINA']
+    filtros = ler_filtros_atividade(request.args)
+    paineis = paineis_atividades(filtros)
+
+    atividades_em_andamento, proximo_andamento = paginar_keyset(*paineis['andamento'], cursor_andamento, limite)
+    atividades_concluidas, proximo_concluidas = paginar_keyset(*paineis['concluidas'], cursor_concluidas, limite)
+
+    return render_template('atividades.html',
+                           atividades_em_andamento=atividades_em_andamento,
+                           atividades_concluidas=atividades_concluidas,
+                           cursor_andamento=cursor_andamento, proximo_andamento=proximo_andamento,
+                           cursor_concluidas=cursor_concluidas, proximo_concluidas=proximo_concluidas,
+                           filtros=filtros, filtros_texto=FILTROS_TEXTO_ATIVIDADE,
+                           ordenacoes=ORDENACOES_ATIVIDADE, **opcoes_formulario_atividade())
 
 @app.route('/atividade/nova', methods=['GET', 'POST'])
 @login_required
@@ -153,87 +2080,123 @@ def nova_atividade():
         if 'imagem' in request.files:
             file = request.files['imagem']
             if file and file.filename != '' and allowed_file(file.filename):
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                nome_arquivo_salvo = f"ativ_{uuid.uuid4()}.{ext}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER_ATIVIDADES'], nome_arquivo_salvo))
+                nome_arquivo_salvo = salvar_upload(file)
         
-        nova = Atividade(
-            nome_atividade=request.form.get('nome_atividade'),
-            prioridade=request.form.get('prioridade'),
-            centro_de_custo=request.form.get('centro_de_custo'),
-            observacoes=request.form.get('observacoes'),
-            pedido=request.form.get('pedido'),
-            local_de_entrega=request.form.get('local_de_entrega'),
-            solicitante=request.form.get('solicitante'),
-            obra_destino=request.form.get('obra_destino'),
-            responsavel_atual=current_user.nome,
-            imagem_anexo=nome_arquivo_salvo
-        )
+        try:
+            nova = Atividade(
+                nome_atividade=request.form.get('nome_atividade'),
+                prioridade=request.form.get('prioridade'),
+                centro_de_custo=request.form.get('centro_de_custo'),
+                observacoes=request.form.get('observacoes'),
+                pedido=request.form.get('pedido'),
+                local_de_entrega=request.form.get('local_de_entrega'),
+                solicitante=request.form.get('solicitante'),
+                obra_destino=request.form.get('obra_destino'),
+                responsavel_atual=current_user.nome,
+                imagem_anexo=nome_arquivo_salvo,
+                anexos=anexos_enviados()
+            )
+        except ValueError as e:
+            # Prioridade fora da tabela de apoio; o rollback descarta os uploads desta requisição.
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return render_template('form_atividade.html', title="Nova Atividade de Engenharia",
+                                   **opcoes_formulario_atividade()), 400
         db.session.add(nova)
-        db.session.commit()
-        
-        hist_criacao = HistoricoModificacao(campo_alterado="Criação da Atividade", valor_novo=f"Atividade '{nova.nome_atividade}' criada.", modificado_por=current_user.nome, atividade_id=nova.id)
-        db.session.add(hist_criacao)
-        if nome_arquivo_salvo:
-            hist_anexo = HistoricoModificacao(campo_alterado="Anexo", valor_novo="Imagem adicionada.", modificado_por=current_user.nome, atividade_id=nova.id)
-            db.session.add(hist_anexo)
-        
+        # O histórico de criação é gravado no mesmo flush (ver HISTÓRICO AUTOMÁTICO).
         db.session.commit()
         flash('Atividade criada com sucesso!', 'success')
         return redirect(url_for('todas_atividades'))
-    return render_template('form_atividade.html', title="Nova Atividade de Engenharia")
+    return render_template('form_atividade.html', title="Nova Atividade de Engenharia", **opcoes_formulario_atividade())
 
 @app.route('/atividade/<int:atividade_id>')
 @login_required
+@resposta_condicional
 def detalhes_atividade(atividade_id):
     atividade = Atividade.query.get_or_404(atividade_id)
-    return render_template('detalhes_atividade.html', atividade=atividade)
+    historico, proximo_historico = pagina_historico(atividade.id)
+    return render_template('detalhes_atividade.html', atividade=atividade,
+                           historico=historico, proximo_historico=proximo_historico)
+
+@app.route('/atividade/<int:atividade_id>/historico')
+@login_required
+def historico_atividade(atividade_id):
+    """Próxima página do histórico ("Carregar mais"), como HTML pronto para anexar à linha do tempo."""
+    if db.session.query(Atividade.id).filter_by(id=atividade_id).scalar() is None:
+        abort(404)
+    historico, proximo_cursor = pagina_historico(atividade_id, request.args.get('cursor'))
+    return jsonify(html=render_template('historico_itens.html', historico=historico), proximo_cursor=proximo_cursor)
+
+def imagem_para_email(atividade):
+    """A imagem anexada, reduzida (derivado 'email'), como data: URI; None se não houver como reduzi-la."""
+    nome = atividade.imagem_anexo
+    if not nome or not eh_imagem(nome) or Image is None:
+        return None
+    pasta = pasta_do_anexo('atividades', nome)
+    caminho = localizar_anexo(os.path.join(pasta, '_derivados'), f'{nome}.email.jpg', chave=nome)
+    try:
+        if not os.path.exists(caminho):
+            # Imagem anterior ao derivado 'email' ou ainda na fila: gera agora, o resultado fica no cache.
+            gerar_derivados(pasta, nome)
+            caminho = caminhos_derivados(pasta, nome)['email']
+        with open(caminho, 'rb') as f:
+            return 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode('ascii')
+    except (OSError, ValueError) as e:
+        app.logger.warning(f"Falha ao reduzir {nome} para o e-mail: {e}")
+        return None
+
+@app.route('/atividade/<int:atividade_id>/email')
+@login_required
+@resposta_condicional
+def email_atividade(atividade_id):
+    """HTML do "Copiar para Email", renderizado só quando pedido e guardado por versão da atividade."""
+    atividade = Atividade.query.get_or_404(atividade_id)
+    # O host entra na chave porque, sem Pillow, a imagem vai como URL absoluta. Uma atividade que
+    # reutiliza o id de outra excluída nasce com versão maior (ver CACHE DE FRAGMENTOS), então não
+    # recebe o e-mail nem a imagem embutida da antiga.
+    chave = ('email_atividade', atividade.id, request.host_url)
+    html = cache_emails.obter(chave, atividade.versao)
+    if html is None:
+        html = render_template('email_atividade.html', atividade=atividade, historico=atividade.historico.all(),
+                               imagem=imagem_para_email(atividade))
+        cache_emails.guardar(chave, atividade.versao, html)
+    return html
 
 @app.route('/atividade/<int:atividade_id>/editar', methods=['GET', 'POST'])
 @login_required
 def editar_atividade(atividade_id):
     atividade = Atividade.query.get_or_404(atividade_id)
     if request.method == 'POST':
-        campos_modificados = []
-        
         if 'imagem' in request.files:
             file = request.files['imagem']
             if file and file.filename != '' and allowed_file(file.filename):
-                if atividade.imagem_anexo:
-                    caminho_antigo = os.path.join(app.config['UPLOAD_FOLDER_ATIVIDADES'], atividade.imagem_anexo)
-                    if os.path.exists(caminho_antigo): os.remove(caminho_antigo)
-                
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                nome_arquivo_salvo = f"ativ_{uuid.uuid4()}.{ext}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER_ATIVIDADES'], nome_arquivo_salvo))
-                
-                campos_modificados.append(('Anexo', atividade.imagem_anexo, nome_arquivo_salvo))
-                atividade.imagem_anexo = nome_arquivo_salvo
-
-        campos_para_verificar = {
-            'nome_atividade': 'Nome da Atividade', 'prioridade': 'Prioridade',
-            'centro_de_custo': 'Centro de Custo', 'status': 'Status', 
-            'observacoes': 'Observações', 'pedido': 'Pedido',
-            'local_de_entrega': 'Local de Entrega', 'solicitante': 'Solicitante',
-            'obra_destino': 'Obra / Destino'
-        }
-        for attr, nome_campo in campos_para_verificar.items():
-            valor_antigo, valor_novo = getattr(atividade, attr), request.form.get(attr)
-            if str(valor_antigo or '') != str(valor_novo or ''):
-                campos_modificados.append((nome_campo, valor_antigo, valor_novo))
-                setattr(atividade, attr, valor_novo)
-        
-        if campos_modificados:
+                atividade.imagem_anexo = salvar_upload(file)
+
+        atividade.anexos.extend(anexos_enviados())
+
+        campos_do_formulario = ('nome_atividade', 'prioridade', 'centro_de_custo', 'status', 'observacoes',
+                                'pedido', 'local_de_entrega', 'solicitante', 'obra_destino')
+        try:
+            for attr in campos_do_formulario:
+                valor_novo = request.form.get(attr)
+                if str(getattr(atividade, attr) or '') != str(valor_novo or ''):
+                    setattr(atividade, attr, valor_novo)
+        except ValueError as e:
+            # Prioridade ou status fora das tabelas de apoio: nada do formulário é gravado.
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return render_template('form_atividade.html', title="Editar Atividade de Engenharia", atividade=atividade,
+                                   **opcoes_formulario_atividade()), 400
+
+        # Uma linha de histórico por campo alterado é gerada no flush (ver HISTÓRICO AUTOMÁTICO).
+        if db.session.is_modified(atividade):
             atividade.responsavel_atual = current_user.nome
-            for campo, antigo, novo in campos_modificados:
-                historico = HistoricoModificacao(campo_alterado=campo, valor_antigo=antigo, valor_novo=novo, modificado_por=current_user.nome, atividade_id=atividade.id)
-                db.session.add(historico)
             db.session.commit()
             flash('Atividade atualizada com sucesso!', 'success')
         else:
             flash('Nenhuma alteração foi feita.', 'info')
         return redirect(url_for('detalhes_atividade', atividade_id=atividade.id))
-    return render_template('form_atividade.html', title="Editar Atividade de Engenharia", atividade=atividade)
+    return render_template('form_atividade.html', title="Editar Atividade de Engenharia", atividade=atividade, **opcoes_formulario_atividade())
 
 @app.route('/atividade/<int:atividade_id>/excluir', methods=['POST'])
 @login_required
@@ -241,9 +2204,6 @@ def excluir_atividade(atividade_id):
     if not current_user.is_admin:
         abort(403)
     atividade = Atividade.query.get_or_404(atividade_id)
-    if atividade.imagem_anexo:
-        caminho_img = os.path.join(app.config['UPLOAD_FOLDER_ATIVIDADES'], atividade.imagem_anexo)
-        if os.path.exists(caminho_img): os.remove(caminho_img)
     db.session.delete(atividade)
     db.session.commit()
     flash(f'Atividade #{atividade.id} foi excluída com sucesso.', 'success')
@@ -253,6 +2213,7 @@ def excluir_atividade(atividade_id):
 
 @app.route('/pedidos')
 @login_required
+@resposta_condicional
 def todos_pedidos():
     pedidos = PedidoProducao.query.order_by(PedidoProducao.data_criacao.desc()).all()
     return render_template('pedidos.html', pedidos=pedidos)
@@ -266,16 +2227,12 @@ def novo_pedido():
         if 'anexo_imagem' in request.files:
             file = request.files['anexo_imagem']
             if file and file.filename != '' and allowed_file(file.filename):
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                imagem_salva = f"img_{uuid.uuid4()}.{ext}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER_PEDIDOS'], imagem_salva))
+                imagem_salva = salvar_upload(file)
 
         if 'anexo_arquivo' in request.files:
             file = request.files['anexo_arquivo']
             if file and file.filename != '' and allowed_file(file.filename):
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                arquivo_salvo = f"file_{uuid.uuid4()}.{ext}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER_PEDIDOS'], arquivo_salvo))
+                arquivo_salvo = salvar_upload(file)
 
         data_termino_str = request.form.get('data_termino_producao')
         data_termino = date.fromisoformat(data_termino_str) if data_termino_str else None
@@ -293,7 +2250,8 @@ def novo_pedido():
             observacoes=request.form.get('observacoes'),
             anexo_imagem_filename=imagem_salva,
             anexo_arquivo_filename=arquivo_salvo,
-            criado_por=current_user.nome
+            criado_por=current_user.nome,
+            anexos=anexos_enviados()
         )
         db.session.add(novo)
         db.session.commit()
@@ -304,10 +2262,695 @@ def novo_pedido():
 
 @app.route('/pedido/<int:pedido_id>')
 @login_required
+@resposta_condicional
 def detalhes_pedido(pedido_id):
     pedido = PedidoProducao.query.get_or_404(pedido_id)
     return render_template('detalhes_pedido.html', pedido=pedido)
 
+# --- ROTAS DE ANEXOS ---
+# Além das colunas de anexo únicas, atividades e pedidos têm quantos arquivos quiserem na tabela
+# anexo. Os arquivos de um envio entram todos na mesma transação; "Baixar todos" monta o ZIP
+# enquanto o envia, arquivo por arquivo e em blocos, sem guardar o ZIP em memória nem em disco.
+ROTULOS_COLUNA_ANEXO = {'imagem_anexo': 'imagem', 'anexo_imagem_filename': 'imagem', 'anexo_arquivo_filename': 'documento'}
+# Formatos que já são comprimidos (docx/xlsx são ZIPs): vão para o pacote sem recompressão.
+EXTENSOES_COMPRIMIDAS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'docx', 'xlsx'}
+
+def anexos_enviados():
+    """Um Anexo (ainda sem dono) para cada arquivo válido do campo múltiplo 'anexos'."""
+    anexos = []
+    for file in request.files.getlist('anexos'):
+        if file and file.filename and allowed_file(file.filename):
+            nome_original = os.path.basename(file.filename.replace('\\', '/'))[:255]
+            nome = salvar_upload(file)
+            anexos.append(Anexo(nome_arquivo=nome, nome_original=nome_original, tamanho=file.stream.tamanho,
+                                enviado_por=current_user.nome))
+    # Arquivos já montados pela API de envio em partes (campo 'uploads' com os ids).
+    ids = request.form.getlist('uploads')
+    if ids:
+        concluidos = UploadParcial.query.filter(UploadParcial.id.in_(ids), UploadParcial.user_id == current_user.id,
+                                                UploadParcial.sha256.isnot(None))
+        for upload in concluidos:
+            nome = f"{upload.sha256}.{upload.extensao}"
+            registrar_upload_pendente(upload.caminho_montado, nome, upload.tamanho)
+            anexos.append(Anexo(nome_arquivo=nome, nome_original=upload.nome_original, tamanho=upload.tamanho,
+                                enviado_por=current_user.nome))
+            db.session.delete(upload)  # a pasta, já vazia depois do commit, sai na reconciliação
+    return anexos
+
+def arquivos_para_zip(obj):
+    """[(caminho, nome no ZIP)] dos anexos de uma atividade/pedido que existem em disco."""
+    pasta_logica = PASTA_LOGICA_ANEXO[type(obj).__name__]
+    candidatos = [(nome, f"{ROTULOS_COLUNA_ANEXO[coluna]}.{nome.rsplit('.', 1)[-1]}")
+                  for coluna, nome in ((c, getattr(obj, c)) for c in COLUNAS_ANEXO[type(obj).__name__]) if nome]
+    candidatos += [(anexo.nome_arquivo, anexo.nome_original) for anexo in obj.anexos]
+    arquivos, usados = [], set()
+    for nome, nome_no_zip in candidatos:
+        caminho = localizar_anexo(pasta_do_anexo(pasta_logica, nome), nome)
+        if not os.path.isfile(caminho):
+            continue
+        base, ext = os.path.splitext(nome_no_zip)
+        n = 2
+        while nome_no_zip.lower() in usados:
+            nome_no_zip = f"{base} ({n}){ext}"
+            n += 1
+        usados.add(nome_no_zip.lower())
+        arquivos.append((caminho, nome_no_zip))
+    return arquivos
+
+class SaidaZip:
+    """Destino sem seek para o zipfile: guarda o que foi escrito até a próxima retirada."""
+    def __init__(self):
+        self.partes = []
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b''.join(self.partes)
+        self.partes.clear()
+        return dados
+
+def gerar_zip(arquivos):
+    """Gera o ZIP em pedaços; a memória usada não depende do número nem do tamanho dos arquivos."""
+    saida = SaidaZip()
+    # Sem seek, o zipfile grava tamanho e CRC de cada arquivo em um descritor depois dos dados.
+    with zipfile.ZipFile(saida, 'w') as pacote:
+        for caminho, nome in arquivos:
+            try:
+                info = zipfile.ZipInfo.from_file(caminho, nome, strict_timestamps=False)
+                origem = open(caminho, 'rb')
+            except FileNotFoundError:
+                continue  # removido depois de listado
+            ext = nome.rsplit('.', 1)[-1].lower()
+            info.compress_type = zipfile.ZIP_STORED if ext in EXTENSOES_COMPRIMIDAS else zipfile.ZIP_DEFLATED
+            with origem, pacote.open(info, 'w') as destino:
+                for bloco in iter(lambda: origem.read(256 * 1024), b''):
+                    destino.write(bloco)
+                    dados = saida.retirar()
+                    if dados:
+                        yield dados
+            yield saida.retirar()
+    yield saida.retirar()  # diretório central
+
+def resposta_zip(obj, nome_arquivo):
+    arquivos = arquivos_para_zip(obj)
+    if not arquivos:
+        abort(404)
+    # O gerador só lê arquivos já resolvidos: não usa a sessão do banco nem o contexto da requisição.
+    resposta = Response(gerar_zip(arquivos), mimetype='application/zip')
+    resposta.headers['Content-Disposition'] = f'attachment; filename="{nome_arquivo}"'
+    resposta.headers['X-Accel-Buffering'] = 'no'
+    return resposta
+
+@app.route('/atividade/<int:atividade_id>/anexos', methods=['POST'])
+@login_required
+def adicionar_anexos_atividade(atividade_id):
+    atividade = Atividade.query.get_or_404(atividade_id)
+    anexos = anexos_enviados()
+    if anexos:
+        atividade.anexos.extend(anexos)
+        atividade.responsavel_atual = current_user.nome
+        db.session.commit()
+        flash(f'{len(anexos)} anexo(s) adicionado(s).', 'success')
+    else:
+        flash('Nenhum arquivo válido foi enviado.', 'info')
+    return redirect(url_for('detalhes_atividade', atividade_id=atividade.id))
+
+@app.route('/pedido/<int:pedido_id>/anexos', methods=['POST'])
+@login_required
+def adicionar_anexos_pedido(pedido_id):
+    pedido = PedidoProducao.query.get_or_404(pedido_id)
+    anexos = anexos_enviados()
+    if anexos:
+        pedido.anexos.extend(anexos)
+        db.session.commit()
+        flash(f'{len(anexos)} anexo(s) adicionado(s).', 'success')
+    else:
+        flash('Nenhum arquivo válido foi enviado.', 'info')
+    return redirect(url_for('detalhes_pedido', pedido_id=pedido.id))
+
+@app.route('/anexo/<int:anexo_id>')
+@login_required
+def baixar_anexo(anexo_id):
+    anexo = Anexo.query.get_or_404(anexo_id)
+    caminho = localizar_anexo(app.config['UPLOAD_FOLDER_CONTEUDO'], anexo.nome_arquivo)
+    if not os.path.isfile(caminho):
+        abort(404)
+    return send_file(caminho, download_name=anexo.nome_original, etag=anexo.nome_arquivo, max_age=UM_ANO)
+
+@app.route('/anexo/<int:anexo_id>/excluir', methods=['POST'])
+@login_required
+def excluir_anexo(anexo_id):
+    anexo = Anexo.query.get_or_404(anexo_id)
+    if not (current_user.is_admin or anexo.enviado_por == current_user.nome):
+        abort(403)
+    if anexo.atividade_id:
+        destino = url_for('detalhes_atividade', atividade_id=anexo.atividade_id)
+    else:
+        destino = url_for('detalhes_pedido', pedido_id=anexo.pedido_id)
+    db.session.delete(anexo)
+    db.session.commit()
+    flash(f"Anexo '{anexo.nome_original}' removido.", 'success')
+    return redirect(destino)
+
+# --- API DE ENVIO EM PARTES ---
+# Para arquivos grandes em redes instáveis: POST /api/uploads {"nome", "tamanho"} devolve o id e o
+# tamanho das partes; cada parte (numerada a partir de 0) vai em PUT /api/uploads/<id>/partes/<n>
+# com o cabeçalho Content-Digest: sha-256=:<base64>: (RFC 9530); GET /api/uploads/<id> lista as
+# partes já recebidas, para retomar; POST /api/uploads/<id>/concluir monta o arquivo. O id é então
+# enviado no campo 'uploads' de nova_atividade/editar_atividade/novo_pedido, que o anexa.
+PADRAO_CONTENT_DIGEST = re.compile(r'sha-256=:([A-Za-z0-9+/]+=*):')
+
+def upload_do_usuario(upload_id):
+    upload = db.session.get(UploadParcial, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+def estado_upload(upload):
+    return {'id': upload.id, 'nome': upload.nome_original, 'tamanho': upload.tamanho,
+            'tamanho_parte': upload.tamanho_parte, 'total_partes': upload.total_partes,
+            'recebidas': upload.partes_recebidas(), 'concluido': upload.sha256 is not None}
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def iniciar_upload_parcial():
+    dados = request.get_json(silent=True) or {}
+    nome = os.path.basename(str(dados.get('nome') or '').replace('\\', '/'))[:255]
+    tamanho = dados.get('tamanho')
+    if not allowed_file(nome) or not isinstance(tamanho, int) or tamanho <= 0:
+        return jsonify(erro='Informe "nome" (com extensão permitida) e "tamanho" em bytes.'), 400
+    limite_mb = app.config['LIMITES_UPLOAD_MB'][nome.rsplit('.', 1)[1].lower()]
+    if tamanho > limite_mb * 1024 * 1024:
+        return jsonify(erro=f'Arquivo acima do limite de {limite_mb} MB para este tipo.'), 413
+    upload = UploadParcial(id=secrets.token_hex(16), user_id=current_user.id, nome_original=nome,
+                           tamanho=tamanho, tamanho_parte=app.config['UPLOAD_PARTE_MB'] * 1024 * 1024)
+    os.makedirs(upload.pasta)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(estado_upload(upload)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def situacao_upload_parcial(upload_id):
+    return jsonify(estado_upload(upload_do_usuario(upload_id)))
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancelar_upload_parcial(upload_id):
+    upload = upload_do_usuario(upload_id)
+    db.session.delete(upload)
+    db.session.commit()
+    shutil.rmtree(upload.pasta, ignore_errors=True)
+    return '', 204
+
+@app.route('/api/uploads/<upload_id>/partes/<int:numero>', methods=['PUT'])
+@login_required
+def enviar_parte_upload(upload_id, numero):
+    upload = upload_do_usuario(upload_id)
+    if upload.sha256 is not None:
+        return jsonify(erro='Envio já concluído.'), 409
+    if not 0 <= numero < upload.total_partes:
+        abort(404)
+    digest = PADRAO_CONTENT_DIGEST.search(request.headers.get('Content-Digest', ''))
+    if digest is None:
+        return jsonify(erro='Cabeçalho Content-Digest (sha-256) ausente.'), 400
+    esperado = upload.tamanho_da_parte(numero)
+    sha256 = hashlib.sha256()
+    recebidos = 0
+    # Gravada num temporário e renomeada: uma parte interrompida nunca aparece como recebida.
+    with tempfile.NamedTemporaryFile(dir=upload.pasta, prefix=f'.{numero}-', delete=False) as temporario:
+        for bloco in iter(lambda: request.stream.read(64 * 1024), b''):
+            recebidos += len(bloco)
+            if recebidos > esperado:
+                break
+            sha256.update(bloco)
+            temporario.write(bloco)
+    if recebidos != esperado:
+        os.remove(temporario.name)
+        return jsonify(erro=f'A parte {numero} deve ter {esperado} bytes.'), 400
+    if not hmac.compare_digest(sha256.digest(), base64.b64decode(digest.group(1))):
+        os.remove(temporario.name)
+        return jsonify(erro=f'Checksum da parte {numero} não confere; envie de novo.'), 400
+    os.replace(temporario.name, upload.caminho_parte(numero))
+    return jsonify(recebidas=len(upload.partes_recebidas()), total_partes=upload.total_partes)
+
+@app.route('/api/uploads/<upload_id>/concluir', methods=['POST'])
+@login_required
+def concluir_upload_parcial(upload_id):
+    upload = upload_do_usuario(upload_id)
+    if upload.sha256 is None:
+        faltando = sorted(set(range(upload.total_partes)) - set(upload.partes_recebidas()))
+        if faltando:
+            return jsonify(erro='Ainda faltam partes.', faltando=faltando), 409
+        sha256 = hashlib.sha256()
+        try:
+            with tempfile.NamedTemporaryFile(dir=upload.pasta, prefix='.montando-', delete=False) as montado:
+                for numero in range(upload.total_partes):
+                    with open(upload.caminho_parte(numero), 'rb') as parte:
+                        for bloco in iter(lambda: parte.read(1024 * 1024), b''):
+                            sha256.update(bloco)
+                            montado.write(bloco)
+        except FileNotFoundError:
+            # Outra chamada de concluir montou o arquivo e apagou as partes no meio desta.
+            os.remove(montado.name)
+            db.session.refresh(upload)
+            if upload.sha256 is None:
+                return jsonify(erro='Ainda faltam partes.'), 409
+            return jsonify(estado_upload(upload))
+        informado = (request.get_json(silent=True) or {}).get('sha256')
+        if informado and informado.lower() != sha256.hexdigest():
+            os.remove(montado.name)
+            return jsonify(erro='O SHA-256 do arquivo montado não confere com o informado.'), 400
+        os.replace(montado.name, upload.caminho_montado)
+        upload.sha256 = sha256.hexdigest()
+        db.session.commit()
+        for numero in range(upload.total_partes):
+            try:
+                os.remove(upload.caminho_parte(numero))
+            except FileNotFoundError:
+                pass
+    return jsonify(estado_upload(upload))
+
+@app.route('/atividade/<int:atividade_id>/anexos.zip')
+@login_required
+def baixar_anexos_atividade(atividade_id):
+    return resposta_zip(Atividade.query.get_or_404(atividade_id), f'atividade-{atividade_id}-anexos.zip')
+
+@app.route('/pedido/<int:pedido_id>/anexos.zip')
+@login_required
+def baixar_anexos_pedido(pedido_id):
+    return resposta_zip(PedidoProducao.query.get_or_404(pedido_id), f'pedido-{pedido_id}-anexos.zip')
+
+
+# --- MIGRAÇÕES DE SCHEMA ---
+# Scripts que criam objetos que os modelos não descrevem (tabelas virtuais, triggers)
+# começam com esta linha e também são executados ao criar um banco novo.
+MARCADOR_BANCO_NOVO = '-- executar-em-banco-novo'
+
+def listar_migracoes():
+    """Retorna [(versao, nome, caminho)] dos scripts NNNN_nome.sql da pasta migrations, em ordem."""
+    migracoes = []
+    for arquivo in sorted(os.listdir(migrations_path)):
+        prefixo, _, resto = arquivo.partition('_')
+        if prefixo.isdigit() and resto.endswith('.sql'):
+            migracoes.append((int(prefixo), resto[:-4], os.path.join(migrations_path, arquivo)))
+    return migracoes
+
+def popular_tabelas_de_apoio():
+    """Insere as prioridades e status padrão que ainda não existirem no banco, e a linha de versao_dados."""
+    prioridades = {p.id for p in Prioridade.query.all()}
+    for id_, codigo, descricao, css_slug in PRIORIDADES_PADRAO:
+        if id_ not in prioridades:
+            db.session.add(Prioridade(id=id_, codigo=codigo, descricao=descricao, css_slug=css_slug))
+    status = {s.id for s in StatusAtividade.query.all()}
+    for id_, nome, ordem, css_slug in STATUS_PADRAO:
+        if id_ not in status:
+            db.session.add(StatusAtividade(id=id_, nome=nome, ordem=ordem, css_slug=css_slug))
+    if db.session.get(VersaoDados, 1) is None:
+        db.session.add(VersaoDados(id=1))
+    db.session.commit()
+
+def aplicar_migracoes():
+    """
+    Leva o banco até a última versão de schema sem recriá-lo.
+    Um banco novo é criado direto pelos modelos (que já declaram os índices) e as
+    migrações são apenas registradas, exceto as marcadas com MARCADOR_BANCO_NOVO;
+    um banco existente recebe os scripts pendentes, cada um em sua própria transação
+    junto com o registro em schema_version.
+    """
+    banco_novo = not inspect(db.engine).has_table('atividade')
+    db.create_all()
+    # As migrações podem referenciar as tabelas de apoio, então elas são populadas antes.
+    popular_tabelas_de_apoio()
+    aplicadas = {v.versao for v in VersaoSchema.query.all()}
+    pendentes = [m for m in listar_migracoes() if m[0] not in aplicadas]
+
+    scripts = {}
+    for versao, _, caminho in pendentes:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            scripts[versao] = f.read()
+
+    executar = pendentes
+    if banco_novo:
+        executar = [m for m in pendentes if scripts[m[0]].startswith(MARCADOR_BANCO_NOVO)]
+        for versao, nome, caminho in pendentes:
+            if (versao, nome, caminho) not in executar:
+                db.session.add(VersaoSchema(versao=versao, nome=nome))
+        db.session.commit()
+        print("Banco de dados criado na versão mais recente do schema.")
+
+    conexao = db.engine.raw_connection()
+    try:
+        bruta = conexao.driver_connection
+        for versao, nome, _ in executar:
+            script = scripts[versao]
+            try:
+                bruta.executescript('BEGIN;\n' + script)
+                bruta.execute('INSERT INTO schema_version (versao, nome, aplicada_em) VALUES (?, ?, ?)',
+                              (versao, nome, datetime.utcnow()))
+                bruta.commit()
+            except Exception:
+                if bruta.in_transaction:
+                    bruta.rollback()
+                raise
+            print(f"Migração {versao:04d} ({nome}) aplicada.")
+    finally:
+        conexao.close()
+    return pendentes
+
+db_cli = AppGroup('db', help='Gerencia o schema do banco de dados.')
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """Aplica as migrações pendentes."""
+    if not aplicar_migracoes():
+        print("Banco de dados já está na versão mais recente.")
+
+@db_cli.command('status')
+def db_status():
+    """Lista as migrações e se já foram aplicadas."""
+    aplicadas = {v.versao: v for v in VersaoSchema.query.all()} if inspect(db.engine).has_table('schema_version') else {}
+    for versao, nome, _ in listar_migracoes():
+        registro = aplicadas.get(versao)
+        situacao = registro.aplicada_em.strftime('%d/%m/%Y %H:%M') if registro else 'pendente'
+        print(f"{versao:04d}  {nome:<40} {situacao}")
+
+def plano_de_consulta(query):
+    """Retorna as linhas de EXPLAIN QUERY PLAN da consulta ORM, com os mesmos parâmetros."""
+    compilada = query.statement.compile(db.engine)
+    parametros = tuple(compilada.params[nome] for nome in compilada.positiontup)
+    resultado = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compilada), parametros)
+    return [linha[3] for linha in resultado]
+
+@db_cli.command('verificar-indices')
+def db_verificar_indices():
+    """
+    Confere que nenhum filtro/ordenação da lista de atividades faz varredura completa.
+    Sem filtro, só é aceito percorrer um índice já na ordem pedida (para no LIMIT);
+    com filtro, a tabela atividade precisa ser acessada por busca (SEARCH) em um índice.
+    """
+    exemplos = {campo: 'x' for campo in FILTROS_TEXTO_ATIVIDADE}
+    exemplos.update({'status': 1, 'prioridade': 1, 'data_inicio': '2024-01-01', 'data_fim': '2024-12-31'})
+    casos = [{}] + [{campo: valor} for campo, valor in exemplos.items()] + [dict(exemplos)]
+    falhas = 0
+    for filtros_base in casos:
+        for ordenar in [None, *ORDENACOES_ATIVIDADE]:
+            filtros = dict(filtros_base, **({'ordenar': ordenar} if ordenar else {}))
+            tem_filtro = bool(filtros_base)
+            for painel, (query, ordenacao) in paineis_atividades(filtros).items():
+                cursor_exemplo = codificar_cursor([datetime(2024, 6, 1) if isinstance(c.type, db.DateTime) else 1
+                                                   for c, _ in ordenacao], ordenacao)
+                for cursor in (None, cursor_exemplo):
+                    plano = plano_de_consulta(consulta_keyset(query, ordenacao, cursor, 25))
+                    varredura = [p for p in plano if re.fullmatch(r'SCAN \w+', p)
+                                 or (tem_filtro and p.startswith('SCAN atividade'))]
+                    falhas += bool(varredura)
+                    situacao = 'FALHA' if varredura else 'ok'
+                    print(f"{situacao:<6}{painel:<11}{'cursor' if cursor else '-':<7}{filtros}  ->  {' | '.join(plano)}")
+    if falhas:
+        print(f"{falhas} consulta(s) com varredura completa de tabela.")
+        raise SystemExit(1)
+    print("Todas as consultas usam índices.")
+
+@db_cli.command('pragmas')
+def db_pragmas():
+    """Mostra os PRAGMAs ativos na conexão do SQLite."""
+    relatar_pragmas()
+
+def relatar_pragmas():
+    perfil = app.config['SQLITE_PERFIL']
+    nomes = list(PERFIS_SQLITE['concorrente'])
+    with db.engine.connect() as conexao:
+        bruta = conexao.connection.driver_connection
+        valores = {nome: bruta.execute(f"PRAGMA {nome}").fetchone()[0] for nome in nomes}
+    print(f"SQLite (perfil '{perfil}'): " + ", ".join(f"{nome}={valor}" for nome, valor in valores.items()))
+
+def executar_benchmark(pragmas, leitores, escritores, segundos, linhas=5000):
+    """
+    Mede leituras/escritas concorrentes em um banco temporário com o conjunto de PRAGMAs dado.
+    Os leitores repetem a consulta da lista de atividades; os escritores imitam editar_atividade
+    (UPDATE na atividade + INSERT no histórico, um commit por edição).
+    """
+    pasta = tempfile.mkdtemp(prefix='bench_sqlite_')
+    caminho = os.path.join(pasta, 'bench.db')
+    con = sqlite3.connect(caminho)
+    aplicar_pragmas(con, pragmas)
+    con.executescript("""
+        CREATE TABLE atividade (id INTEGER PRIMARY KEY, nome TEXT, status_id INTEGER, data_criacao TEXT);
+        CREATE INDEX ix_atividade_status_data_criacao ON atividade (status_id, data_criacao);
+        CREATE TABLE historico (id INTEGER PRIMARY KEY, atividade_id INTEGER, valor_novo TEXT);
+    """)
+    con.executemany('INSERT INTO atividade (nome, status_id, data_criacao) VALUES (?, ?, ?)',
+                    [(f'Atividade {i}', i % 4 + 1, f'2024-01-01 {i % 24:02d}:00:{i % 60:02d}') for i in range(linhas)])
+    con.commit()
+    con.close()
+
+    resultado = {'leituras': 0, 'escritas': 0, 'bloqueios': 0, 'latencias': []}
+    trava = threading.Lock()
+    fim = time.monotonic() + segundos
+
+    def leitor():
+        conexao = sqlite3.connect(caminho)
+        aplicar_pragmas(conexao, pragmas)
+        leituras, latencias, bloqueios = 0, [], 0
+        while time.monotonic() < fim:
+            inicio = time.perf_counter()
+            try:
+                conexao.execute('SELECT * FROM atividade WHERE status_id = 4 ORDER BY data_criacao DESC LIMIT 25').fetchall()
+                leituras += 1
+                latencias.append(time.perf_counter() - inicio)
+            except sqlite3.OperationalError:
+                bloqueios += 1
+        conexao.close()
+        with trava:
+            resultado['leituras'] += leituras
+            resultado['latencias'].extend(latencias)
+            resultado['bloqueios'] += bloqueios
+
+    def escritor(n):
+        conexao = sqlite3.connect(caminho)
+        aplicar_pragmas(conexao, pragmas)
+        escritas, bloqueios, i = 0, 0, 0
+        while time.monotonic() < fim:
+            i += 1
+            alvo = (n * 7919 + i) % linhas + 1
+            try:
+                conexao.execute('UPDATE atividade SET status_id = ? WHERE id = ?', (i % 4 + 1, alvo))
+                conexao.execute('INSERT INTO historico (atividade_id, valor_novo) VALUES (?, ?)', (alvo, 'x' * 200))
+                conexao.commit()
+                escritas += 1
+            except sqlite3.OperationalError:
+                conexao.rollback()
+                bloqueios += 1
+        conexao.close()
+        with trava:
+            resultado['escritas'] += escritas
+            resultado['bloqueios'] += bloqueios
+
+    threads = [threading.Thread(target=leitor) for _ in range(leitores)]
+    threads += [threading.Thread(target=escritor, args=(n,)) for n in range(escritores)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for arquivo in os.listdir(pasta):
+        os.remove(os.path.join(pasta, arquivo))
+    os.rmdir(pasta)
+
+    latencias = sorted(resultado['latencias']) or [0.0]
+    resultado['p50_ms'] = latencias[len(latencias) // 2] * 1000
+    resultado['p99_ms'] = latencias[int(len(latencias) * 0.99)] * 1000
+    return resultado
+
+@db_cli.command('benchmark')
+@click.option('--leitores', default=8, show_default=True, help='Threads fazendo leituras.')
+@click.option('--escritores', default=2, show_default=True, help='Threads fazendo edições.')
+@click.option('--segundos', default=5.0, show_default=True, help='Duração de cada rodada.')
+def db_benchmark(leitores, escritores, segundos):
+    """Compara a concorrência do perfil 'padrao' com o perfil configurado."""
+    perfis = ['padrao', app.config['SQLITE_PERFIL']] if app.config['SQLITE_PERFIL'] != 'padrao' else ['padrao']
+    print(f"{'perfil':<14}{'leituras/s':>12}{'escritas/s':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}{'locked':>8}")
+    for perfil in perfis:
+        r = executar_benchmark(PERFIS_SQLITE[perfil], leitores, escritores, segundos)
+        print(f"{perfil:<14}{r['leituras'] / segundos:>12.0f}{r['escritas'] / segundos:>12.0f}"
+              f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['bloqueios']:>8}")
+
+app.cli.add_command(db_cli)
+
+
+# --- IMPORTAÇÃO DE USUÁRIOS ---
+# Cada lote de registros custa uma consulta IN para os logins existentes, um INSERT em lote para os
+# novos e os hashes das senhas em texto puro calculados em paralelo. Tudo em uma única transação.
+def ler_registros_usuarios(caminho):
+    """Lê usuários de um .csv (linha a linha) ou .json ({"usuarios": [...]} ou lista)."""
+    if caminho.lower().endswith('.csv'):
+        with open(caminho, newline='', encoding='utf-8-sig') as f:
+            for linha in csv.DictReader(f):
+                # Células vazias ficam de fora: no upsert, campo ausente mantém o valor atual.
+                yield {chave: valor for chave, valor in linha.items() if valor not in (None, '')}
+    else:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        yield from data.get('usuarios', []) if isinstance(data, dict) else data
+
+VALORES_VERDADEIROS = {'1', 'true', 'sim', 's', 'x', 'yes', 'y'}
+VALORES_FALSOS = {'0', 'false', 'nao', 'não', 'n', 'no'}
+
+def valor_booleano(valor):
+    """is_admin vindo do CSV (texto) ou do JSON (bool, número ou texto); None se ausente ou irreconhecível."""
+    if valor is None or isinstance(valor, bool):
+        return valor
+    if isinstance(valor, (int, float)):
+        return bool(valor)
+    texto = str(valor).strip().lower()
+    if texto in VALORES_VERDADEIROS:
+        return True
+    if texto in VALORES_FALSOS:
+        return False
+    return None
+
+def importar_usuarios(registros, upsert=False, dry_run=False, lote=500, processos=None):
+    """Insere (ou, com upsert, atualiza) usuários; devolve um Counter com o resultado por registro."""
+    resultado = Counter()
+    vistos = set()
+    metodo = app.config['SENHA_METODO']
+    registros = iter(registros)
+    pool = None if dry_run else ProcessPoolExecutor(max_workers=processos or os.cpu_count() or 1)
+    try:
+        while True:
+            bloco = []
+            for user_data in islice(registros, lote):
+                login = (user_data.get('login') or '').strip()
+                if not login or login in vistos:
+                    resultado['ignorados'] += 1
+                    print(f"Registro sem login ou com login repetido ({login or '-'}). Pulando.")
+                    continue
+                if not user_data.get('senha_hash') and not user_data.get('senha'):
+                    resultado['ignorados'] += 1
+                    print(f"Usuário '{login}' sem senha ou hash. Pulando.")
+                    continue
+                vistos.add(login)
+                registro = dict(user_data, login=login)
+                registro.pop('is_admin', None)
+                is_admin = valor_booleano(user_data.get('is_admin'))
+                if is_admin is not None:
+                    registro['is_admin'] = is_admin
+                elif user_data.get('is_admin') not in (None, ''):
+                    print(f"Usuário '{login}': is_admin {user_data['is_admin']!r} não reconhecido; campo ignorado.")
+                bloco.append(registro)
+            if not bloco:
+                break
+
+            existentes = {u.login: u for u in User.query.filter(User.login.in_([r['login'] for r in bloco]))}
+            if not upsert:
+                for r in bloco:
+                    if r['login'] in existentes:
+                        resultado['existentes'] += 1
+                        print(f"Usuário '{r['login']}' já existe no banco de dados. Pulando.")
+                bloco = [r for r in bloco if r['login'] not in existentes]
+
+            if not dry_run:
+                sem_hash = [r for r in bloco if not r.get('senha_hash')]
+                hashes = pool.map(generate_password_hash, [r['senha'] for r in sem_hash], repeat(metodo), chunksize=8)
+                for r, senha_hash in zip(sem_hash, hashes):
+                    r['senha_hash'] = senha_hash
+
+            novos = []
+            for r in bloco:
+                usuario = existentes.get(r['login'])
+                if usuario is None:
+                    novos.append({'login': r['login'], 'nome': r.get('nome') or r['login'],
+                                  'senha_hash': r.get('senha_hash'), 'is_admin': bool(r.get('is_admin', False))})
+                    resultado['inseridos'] += 1
+                else:
+                    usuario.nome = r.get('nome') or usuario.nome
+                    if 'is_admin' in r:
+                        usuario.is_admin = r['is_admin']
+                    if not dry_run:
+                        usuario.senha_hash = r['senha_hash']
+                    resultado['atualizados'] += 1
+            if novos and not dry_run:
+                db.session.execute(db.insert(User), novos)
+            db.session.flush()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return resultado
+
+users_cli = AppGroup('users', help='Cadastro de usuários.')
+
+@users_cli.command('import')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--upsert', is_flag=True, help='Atualiza nome, perfil e senha dos logins que já existem.')
+@click.option('--dry-run', is_flag=True, help='Só relata o que seria feito (sem gravar nem calcular hashes).')
+@click.option('--lote', default=500, show_default=True, help='Registros por consulta/INSERT.')
+@click.option('--processos', default=None, type=int, help='Processos para os hashes (padrão: núcleos da CPU).')
+def users_import(arquivo, upsert, dry_run, lote, processos):
+    """Importa usuários de um arquivo JSON ou CSV (colunas login, nome, senha ou senha_hash, is_admin)."""
+    inicio = time.perf_counter()
+    resultado = importar_usuarios(ler_registros_usuarios(arquivo), upsert=upsert, dry_run=dry_run,
+                                  lote=lote, processos=processos)
+    prefixo = "[dry-run] " if dry_run else ""
+    print(f"{prefixo}{resultado['inseridos']} inserido(s), {resultado['atualizados']} atualizado(s), "
+          f"{resultado['existentes']} já existente(s), {resultado['ignorados']} ignorado(s) "
+          f"em {time.perf_counter() - inicio:.1f}s.")
+
+app.cli.add_command(users_cli)
+
+tokens_cli = AppGroup('tokens', help='Tokens pessoais de API.')
+
+@tokens_cli.command('criar')
+@click.argument('login')
+@click.option('--nome', required=True, help='Para que serve o token (ex.: nome do script).')
+@click.option('--escopo', 'escopos', multiple=True, type=click.Choice(ESCOPOS_TOKEN), default=('leitura',), show_default=True)
+@click.option('--dias', type=int, default=90, show_default=True, help='Validade em dias (0 = sem expiração).')
+def tokens_criar(login, nome, escopos, dias):
+    """Cria um token para o usuário e mostra o valor (uma única vez)."""
+    usuario = User.query.filter_by(login=login).first()
+    if usuario is None:
+        raise click.ClickException(f"Usuário '{login}' não encontrado.")
+    expira_em = datetime.utcnow() + timedelta(days=dias) if dias else None
+    registro, token = gerar_token_api(usuario, nome, escopos, expira_em)
+    db.session.commit()
+    print(f"Token #{registro.id} criado para '{login}' ({' '.join(escopos)}). Guarde-o; ele não será mostrado de novo:")
+    print(token)
+    print("Uso: Authorization: Bearer <token>")
+
+@tokens_cli.command('listar')
+@click.argument('login', required=False)
+def tokens_listar(login):
+    """Lista os tokens (de um usuário ou de todos)."""
+    consulta = TokenApi.query.join(TokenApi.usuario).order_by(TokenApi.id)
+    if login:
+        consulta = consulta.filter(User.login == login)
+    for t in consulta:
+        situacao = 'revogado' if t.revogado_em else (
+            'expirado' if t.expira_em and t.expira_em <= datetime.utcnow() else 'ativo')
+        validade = t.expira_em.strftime('%d/%m/%Y') if t.expira_em else 'sem expiração'
+        print(f"#{t.id} {t.prefixo}… {t.usuario.login} '{t.nome}' [{t.escopos}] {validade} {situacao}")
+
+@tokens_cli.command('revogar')
+@click.argument('token_id', type=int)
+def tokens_revogar(token_id):
+    """Revoga um token pelo id."""
+    registro = db.session.get(TokenApi, token_id)
+    if registro is None:
+        raise click.ClickException(f"Token #{token_id} não encontrado.")
+    registro.revogado_em = datetime.utcnow()
+    db.session.commit()
+    print(f"Token #{token_id} revogado.")
+
+app.cli.add_command(tokens_cli)
+
 
 # --- INICIALIZAÇÃO E FUNÇÕES FINAIS ---
 @app.context_processor
@@ -325,47 +2968,17 @@ def migrar_usuarios_json_para_db():
             print("Arquivo de backup de usuários (usuarios.json.bkp) não encontrado. Pulando migração.")
             return
 
-        with open(usuarios_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        for user_data in data.get('usuarios', []):
-            login = user_data.get('login')
-            if not login:
-                continue
-
-            # Verifica se o usuário já existe
-            if User.query.filter_by(login=login).first():
-                print(f"Usuário '{login}' já existe no banco de dados. Pulando.")
-                continue
-
-            # Garante que a senha tenha hash
-            senha_hash = user_data.get('senha_hash')
-            if not senha_hash and 'senha' in user_data:
-                senha_hash = generate_password_hash(user_data['senha'], method='pbkdf2:sha256')
-
-            if not senha_hash:
-                print(f"Usuário '{login}' sem senha ou hash. Pulando.")
-                continue
-
-            novo_usuario = User(
-                login=login,
-                nome=user_data.get('nome'),
-                senha_hash=senha_hash,
-                is_admin=user_data.get('is_admin', False)
-            )
-            db.session.add(novo_usuario)
-            print(f"Usuário '{login}' migrado para o banco de dados.")
-        
-        db.session.commit()
-        print("Migração de usuários concluída.")
+        resultado = importar_usuarios(ler_registros_usuarios(usuarios_json_path))
+        print(f"Migração de usuários concluída ({resultado['inseridos']} migrado(s)).")
 
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print(f"Erro ao processar o arquivo de usuários JSON: {e}")
 
 def inicializar_db():
-    """Cria as tabelas e executa a migração inicial de usuários se necessário."""
+    """Cria/atualiza as tabelas e executa a migração inicial de usuários se necessário."""
     with app.app_context():
-        db.create_all()
+        aplicar_migracoes()
+        relatar_pragmas()
         # A função de migração será executada se a tabela de usuários estiver vazia.
         if not User.query.first():
             print("Tabela de usuários vazia. Tentando migrar de 'usuarios.json.bkp'...")
@@ -0,0 +1,8 @@
+-- Índices para as consultas de atividades:
+--   index()             -> ORDER BY data_criacao DESC LIMIT 5
+--   todas_atividades()  -> concluídas: WHERE status = ? ORDER BY data_criacao DESC, id DESC
+--                          em andamento: ORDER BY prioridade, data_criacao DESC, id DESC
+--                          (percorrido de trás para frente no índice prioridade DESC, data_criacao)
+CREATE INDEX IF NOT EXISTS ix_atividade_data_criacao ON atividade (data_criacao);
+CREATE INDEX IF NOT EXISTS ix_atividade_status_data_criacao ON atividade (status, data_criacao);
+CREATE INDEX IF NOT EXISTS ix_atividade_prioridade_data_criacao ON atividade (prioridade DESC, data_criacao);
@@ -0,0 +1,5 @@
+-- Índices para o histórico da página de detalhes e para a lista de pedidos:
+--   Atividade.historico -> WHERE atividade_id = ? ORDER BY data_modificacao DESC
+--   todos_pedidos()/index() -> ORDER BY data_criacao DESC
+CREATE INDEX IF NOT EXISTS ix_historico_modificacao_atividade_data ON historico_modificacao (atividade_id, data_modificacao);
+CREATE INDEX IF NOT EXISTS ix_pedido_producao_data_criacao ON pedido_producao (data_criacao);
@@ -0,0 +1,50 @@
+-- Prioridade e status passam a ser chaves inteiras para as tabelas de apoio
+-- prioridade/status_atividade (criadas e populadas antes das migrações).
+-- Valores antigos fora do padrão ganham uma linha própria nas tabelas de apoio.
+INSERT INTO prioridade (id, codigo, descricao, css_slug)
+SELECT (SELECT MAX(id) FROM prioridade) + ROW_NUMBER() OVER (ORDER BY prioridade), prioridade, prioridade,
+       lower(replace(prioridade, ' ', '-'))
+FROM (SELECT DISTINCT prioridade FROM atividade WHERE prioridade NOT IN (SELECT codigo FROM prioridade));
+
+INSERT INTO status_atividade (id, nome, ordem, css_slug)
+SELECT (SELECT MAX(id) FROM status_atividade) + ROW_NUMBER() OVER (ORDER BY status), status,
+       (SELECT MAX(ordem) FROM status_atividade) + ROW_NUMBER() OVER (ORDER BY status),
+       lower(replace(replace(replace(status, ' ', '-'), 'ã', 'a'), 'ç', 'c'))
+FROM (SELECT DISTINCT status FROM atividade WHERE status NOT IN (SELECT nome FROM status_atividade));
+
+-- O SQLite não altera NOT NULL/FOREIGN KEY de colunas existentes: a tabela é reconstruída.
+CREATE TABLE atividade_nova (
+	id INTEGER NOT NULL, 
+	nome_atividade VARCHAR(200) NOT NULL, 
+	prioridade_id SMALLINT NOT NULL, 
+	imagem_anexo VARCHAR(100), 
+	observacoes TEXT, 
+	data_criacao DATETIME NOT NULL, 
+	centro_de_custo VARCHAR(100) NOT NULL, 
+	status_id SMALLINT NOT NULL, 
+	responsavel_atual VARCHAR(150) NOT NULL, 
+	pedido VARCHAR(100), 
+	local_de_entrega VARCHAR(200), 
+	solicitante VARCHAR(150), 
+	obra_destino VARCHAR(200), 
+	PRIMARY KEY (id), 
+	FOREIGN KEY(prioridade_id) REFERENCES prioridade (id), 
+	FOREIGN KEY(status_id) REFERENCES status_atividade (id)
+);
+
+INSERT INTO atividade_nova (id, nome_atividade, prioridade_id, imagem_anexo, observacoes, data_criacao,
+                            centro_de_custo, status_id, responsavel_atual, pedido, local_de_entrega,
+                            solicitante, obra_destino)
+SELECT a.id, a.nome_atividade, p.id, a.imagem_anexo, a.observacoes, a.data_criacao,
+       a.centro_de_custo, s.id, a.responsavel_atual, a.pedido, a.local_de_entrega,
+       a.solicitante, a.obra_destino
+FROM atividade a
+JOIN prioridade p ON p.codigo = a.prioridade
+JOIN status_atividade s ON s.nome = a.status;
+
+DROP TABLE atividade;
+ALTER TABLE atividade_nova RENAME TO atividade;
+
+CREATE INDEX ix_atividade_data_criacao ON atividade (data_criacao);
+CREATE INDEX ix_atividade_status_data_criacao ON atividade (status_id, data_criacao);
+CREATE INDEX ix_atividade_prioridade_data_criacao ON atividade (prioridade_id DESC, data_criacao);
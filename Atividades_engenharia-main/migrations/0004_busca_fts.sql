@@ -0,0 +1,54 @@
+-- executar-em-banco-novo
+-- Índice de texto completo (FTS5) para /busca sobre atividades, pedidos e histórico.
+-- O rowid codifica a origem da linha: id * 4 + tipo (1 = atividade, 2 = pedido, 3 = histórico),
+-- assim os triggers atualizam/removem a linha certa por chave primária, sem varrer o índice.
+CREATE VIRTUAL TABLE IF NOT EXISTS busca_fts USING fts5(
+    titulo, pedido, solicitante, destino, centro_de_custo, texto,
+    atividade_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS busca_atividade_ai AFTER INSERT ON atividade BEGIN
+    INSERT INTO busca_fts (rowid, titulo, pedido, solicitante, destino, centro_de_custo, texto, atividade_id)
+    VALUES (new.id * 4 + 1, new.nome_atividade, new.pedido, new.solicitante, new.obra_destino,
+            new.centro_de_custo, new.observacoes, new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS busca_atividade_au AFTER UPDATE OF nome_atividade, pedido, solicitante, obra_destino, centro_de_custo, observacoes ON atividade BEGIN
+    UPDATE busca_fts SET titulo = new.nome_atividade, pedido = new.pedido, solicitante = new.solicitante,
+                         destino = new.obra_destino, centro_de_custo = new.centro_de_custo, texto = new.observacoes
+    WHERE rowid = old.id * 4 + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS busca_atividade_ad AFTER DELETE ON atividade BEGIN
+    DELETE FROM busca_fts WHERE rowid = old.id * 4 + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS busca_pedido_ai AFTER INSERT ON pedido_producao BEGIN
+    INSERT INTO busca_fts (rowid, titulo, pedido, solicitante, destino, centro_de_custo, texto)
+    VALUES (new.id * 4 + 2, new.nome, new.pedido, new.solicitante, new.destino, new.centro_de_custo, new.observacoes);
+END;
+CREATE TRIGGER IF NOT EXISTS busca_pedido_au AFTER UPDATE OF nome, pedido, solicitante, destino, centro_de_custo, observacoes ON pedido_producao BEGIN
+    UPDATE busca_fts SET titulo = new.nome, pedido = new.pedido, solicitante = new.solicitante,
+                         destino = new.destino, centro_de_custo = new.centro_de_custo, texto = new.observacoes
+    WHERE rowid = old.id * 4 + 2;
+END;
+CREATE TRIGGER IF NOT EXISTS busca_pedido_ad AFTER DELETE ON pedido_producao BEGIN
+    DELETE FROM busca_fts WHERE rowid = old.id * 4 + 2;
+END;
+
+CREATE TRIGGER IF NOT EXISTS busca_historico_ai AFTER INSERT ON historico_modificacao BEGIN
+    INSERT INTO busca_fts (rowid, texto, atividade_id) VALUES (new.id * 4 + 3, new.valor_novo, new.atividade_id);
+END;
+CREATE TRIGGER IF NOT EXISTS busca_historico_ad AFTER DELETE ON historico_modificacao BEGIN
+    DELETE FROM busca_fts WHERE rowid = old.id * 4 + 3;
+END;
+
+-- Carga inicial com os registros que já existem.
+DELETE FROM busca_fts;
+INSERT INTO busca_fts (rowid, titulo, pedido, solicitante, destino, centro_de_custo, texto, atividade_id)
+SELECT id * 4 + 1, nome_atividade, pedido, solicitante, obra_destino, centro_de_custo, observacoes, id FROM atividade;
+INSERT INTO busca_fts (rowid, titulo, pedido, solicitante, destino, centro_de_custo, texto)
+SELECT id * 4 + 2, nome, pedido, solicitante, destino, centro_de_custo, observacoes FROM pedido_producao;
+INSERT INTO busca_fts (rowid, texto, atividade_id)
+SELECT id * 4 + 3, valor_novo, atividade_id FROM historico_modificacao;
+INSERT INTO busca_fts (busca_fts) VALUES ('optimize');
@@ -0,0 +1,6 @@
+-- Índices para os filtros da lista de atividades (todas_atividades / aplicar_filtros_atividade).
+-- Cada filtro de texto é um intervalo de prefixo na coluna; data_criacao em seguida ajuda a ordenação.
+CREATE INDEX IF NOT EXISTS ix_atividade_centro_de_custo_data ON atividade (centro_de_custo, data_criacao);
+CREATE INDEX IF NOT EXISTS ix_atividade_solicitante_data ON atividade (solicitante, data_criacao);
+CREATE INDEX IF NOT EXISTS ix_atividade_obra_destino_data ON atividade (obra_destino, data_criacao);
+CREATE INDEX IF NOT EXISTS ix_atividade_responsavel_atual_data ON atividade (responsavel_atual, data_criacao);
@@ -0,0 +1,14 @@
+-- Carga inicial dos contadores do dashboard (contador_painel) a partir dos dados existentes.
+-- Depois disso eles são mantidos pelos eventos de flush; 'flask painel recalcular' refaz a carga.
+DELETE FROM contador_painel;
+INSERT INTO contador_painel (chave, valor)
+SELECT 'status:' || status_id, count(*) FROM atividade GROUP BY status_id;
+INSERT INTO contador_painel (chave, valor)
+SELECT 'prioridade:' || prioridade_id, count(*) FROM atividade WHERE status_id != 4 GROUP BY prioridade_id;
+INSERT INTO contador_painel (chave, valor)
+SELECT 'centro_de_custo:' || centro_de_custo, count(*) FROM atividade WHERE status_id != 4 GROUP BY centro_de_custo;
+INSERT INTO contador_painel (chave, valor)
+SELECT 'entrega:' || data_prevista_entrega, count(*) FROM pedido_producao
+WHERE data_prevista_entrega IS NOT NULL GROUP BY data_prevista_entrega;
+INSERT INTO contador_painel (chave, valor) SELECT 'pedidos', count(*) FROM pedido_producao;
+-- 'atrasados'/'atrasados_ate' ficam de fora: a primeira leitura do dashboard soma todos os buckets vencidos.
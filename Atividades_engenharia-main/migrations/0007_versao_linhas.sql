@@ -0,0 +1,3 @@
+-- Versão por linha de atividade e pedido, usada como chave do cache de fragmentos renderizados.
+ALTER TABLE atividade ADD COLUMN versao INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE pedido_producao ADD COLUMN versao INTEGER NOT NULL DEFAULT 1;